@@ -3,9 +3,16 @@ from __future__ import annotations
 
 import json
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, List
 
+try:
+    import orjson  # 高速JSONパーサ（任意依存）
+except ImportError:
+    orjson = None
+
 from timetable_models import StopTime, TimetableTrain
 from train_state import TrainSegment, build_yamanote_segments
 try:
@@ -17,6 +24,41 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# JR East の主要路線（ODPT API でサポートされている路線）の時刻表
+TIMETABLE_FILES = [
+    "jreast-yamanote.json",
+    "jreast-chuorapid.json",
+    "jreast-keihintohokunegishi.json",
+    "jreast-chuosobulocal.json",
+    "jreast-yokohama.json",
+    "jreast-saikyokawagoe.json",
+    "jreast-nambu.json",
+    "jreast-joban.json",
+    "jreast-jobanrapid.json",
+    "jreast-jobanlocal.json",
+    "jreast-keiyo.json",
+    "jreast-musashino.json",
+    "jreast-soburapid.json",
+    "jreast-tokaido.json",
+    "jreast-yokosuka.json",
+    "jreast-takasaki.json",
+    "jreast-utsunomiya.json",
+    "jreast-shonanshinjuku.json",
+]
+
+# 静的ファイル読み込み用のスレッド数（ファイル I/O 中は GIL が解放される）
+_FILE_READ_WORKERS = 8
+
+# 駅名 → 座標の検索結果を覚えておく件数の上限（入力はユーザー由来のため無制限にはしない）
+_COORD_BY_NAME_CACHE_MAX = 4096
+
+
+def _parse_json_bytes(raw: bytes) -> Any:
+    """bytes のまま JSON を解析する（orjson はデコード処理を省略できる）"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 
 def _is_valid_coord(lon: float, lat: float) -> bool:
     """
@@ -206,11 +248,15 @@ def _parse_yamanote_timetables(raw_data: List[Dict[str, Any]]) -> List[Timetable
             number: str = row.get("n", "")
             train_type: str = row.get("y", "")
             direction: str = row.get("d", "")
+            # direction / service_type は列車ごとの辞書キーや並び替えで何度もハッシュされるため、
+            # 読み込み時に intern して同じ文字列オブジェクトを共有する
+            if direction:
+                direction = sys.intern(direction)
 
             # service_type を id の末尾から推定
             service_type = "Unknown"
             if "." in full_id:
-                suffix = full_id.split(".")[-1]
+                suffix = sys.intern(full_id.split(".")[-1])
                 service_type = suffix
                 if suffix not in ("Weekday", "Holiday"):
                     logger.info(
@@ -298,6 +344,8 @@ class DataCache:
 
         # MS3-3: 駅座標インデックス
         self.station_positions: Dict[str, tuple[float, float]] = {}
+        # 同じ座標を (lat, lon) の順で持つもの（呼び出し側での組み替えを省く）
+        self.station_latlon: Dict[str, tuple[float, float]] = {}
 
         # 駅ランクキャッシュ (station_id -> {"rank": str, "dwell_time": int})
         self.station_rank_cache: Dict[str, Dict[str, Any]] = {}
@@ -315,57 +363,73 @@ class DataCache:
         # 駅名検索用インデックス
         # key: 駅名（日本語/英語）, value: 駅情報のリスト
         self.station_search_index: List[Dict[str, Any]] = []
+        # get_station_coord_by_name の結果（インデックス再構築時にクリア）
+        self._coord_by_name_cache: Dict[str, tuple[float, float] | None] = {}
 
-        # TODO (MS6): パフォーマンス最適化
-        # self.railways_by_id: Dict[str, Dict[str, Any]] = {}
-        # self.stations_by_id: Dict[str, Dict[str, Any]] = {}
+        # /api/stations 用: 路線ID → APIレスポンス形式の駅リスト（起動時に構築）
+        self.stations_transformed_by_line: Dict[str, List[Dict[str, Any]]] = {}
+        # 駅ID → 上記リスト内の dict（ランク更新時に同じ dict を書き換える）
+        self._station_api_by_id: Dict[str, Dict[str, Any]] = {}
 
-    def _load_json(self, rel_path: str) -> Any:
+        # 路線ID → railways.json のエントリ / coordinates.json のエントリ
+        self.railways_by_id: Dict[str, Dict[str, Any]] = {}
+        self.coord_entries_by_id: Dict[str, Dict[str, Any]] = {}
+
+        # /api/debug/available_shapes 用: coordinates.json の路線ID（ソート済み）
+        self.shape_ids_sorted: tuple[str, ...] = ()
+        self.shape_ids_chuo: tuple[str, ...] = ()
+
+        # /api/lines 用: 要約形式の路線リスト（全体 / 事業者ID別）
+        self.line_summaries: List[Dict[str, Any]] = []
+        self.line_summaries_by_operator: Dict[str, List[Dict[str, Any]]] = {}
+
+    def _read_bytes(self, rel_path: str) -> bytes:
         path = self.data_dir / rel_path
         if not path.exists():
             raise FileNotFoundError(f"JSON file not found: {path}")
-        with path.open("r", encoding="utf-8") as f:
-            return json.load(f)
+        return path.read_bytes()
+
+    def _load_json(self, rel_path: str) -> Any:
+        return _parse_json_bytes(self._read_bytes(rel_path))
 
     def load_all(self) -> None:
         """全ての静的データを読み込む（MS1+MS2+MS3-1 用）"""
+        # ファイル読み込みはスレッドで先行させ、解析・インデックス構築と重ねる
+        with ThreadPoolExecutor(max_workers=_FILE_READ_WORKERS) as pool:
+            self._load_all(pool)
+
+    def _load_all(self, pool: ThreadPoolExecutor) -> None:
+        railways_raw = pool.submit(self._read_bytes, "mini-tokyo-3d/railways.json")
+        coordinates_raw = pool.submit(self._read_bytes, "mini-tokyo-3d/coordinates.json")
+        timetable_raws = [
+            (filename, pool.submit(self._read_bytes, f"mini-tokyo-3d/train-timetables/{filename}"))
+            for filename in TIMETABLE_FILES
+        ]
+
         # 1) MS2 までのデータ
-        self.railways = self._load_json("mini-tokyo-3d/railways.json")
+        self.railways = _parse_json_bytes(railways_raw.result())
         # Step 2: Stop loading stations.json
         # self.stations = self._load_json("mini-tokyo-3d/stations.json")
-        self.coordinates = self._load_json("mini-tokyo-3d/coordinates.json")
+        self.coordinates = _parse_json_bytes(coordinates_raw.result())
 
         logger.info("Loaded %d railways", len(self.railways))
 
-        # 2) 複数路線の時刻表をロード
-        # JR East の主要路線（ODPT API でサポートされている路線）
-        TIMETABLE_FILES = [
-            "jreast-yamanote.json",
-            "jreast-chuorapid.json",
-            "jreast-keihintohokunegishi.json",
-            "jreast-chuosobulocal.json",
-            "jreast-yokohama.json",
-            "jreast-saikyokawagoe.json",
-            "jreast-nambu.json",
-            "jreast-joban.json",
-            "jreast-jobanrapid.json",
-            "jreast-jobanlocal.json",
-            "jreast-keiyo.json",
-            "jreast-musashino.json",
-            "jreast-soburapid.json",
-            "jreast-tokaido.json",
-            "jreast-yokosuka.json",
-            "jreast-takasaki.json",
-            "jreast-utsunomiya.json",
-            "jreast-shonanshinjuku.json",
-        ]
-        
+        # 路線IDでの O(1) 参照用インデックス
+        self.railways_by_id = {l["id"]: l for l in self.railways if "id" in l}
+        self.coord_entries_by_id = {
+            c["id"]: c for c in self.coordinates.get("railways", []) if "id" in c
+        }
+        self.shape_ids_sorted = tuple(sorted(self.coord_entries_by_id))
+        self.shape_ids_chuo = tuple(i for i in self.shape_ids_sorted if "Chuo" in i)
+        self.build_line_summary_index()
+
+        # 2) 複数路線の時刻表をロード（読み込み済みの bytes を順に解析する）
         self.all_trains: List[TimetableTrain] = []
         total_loaded = 0
         
-        for filename in TIMETABLE_FILES:
+        for filename, raw_future in timetable_raws:
             try:
-                raw_data = self._load_json(f"mini-tokyo-3d/train-timetables/{filename}")
+                raw_data = _parse_json_bytes(raw_future.result())
                 trains = _parse_yamanote_timetables(raw_data)  # Generic parser
                 self.all_trains.extend(trains)
                 total_loaded += len(trains)
@@ -402,6 +466,9 @@ class DataCache:
         # 駅名検索インデックスの構築 (DBから)
         self.build_station_search_index()
 
+        # /api/stations 用の路線別駅リストの構築 (DBから、ランク読み込み後)
+        self.build_station_api_index()
+
         # MS3-5: 線路形状データの読み込みと駅マッピング
         self._load_track_coordinates()
 
@@ -640,13 +707,14 @@ class DataCache:
 
     def get_station_rank_data(self, station_id: str) -> Dict[str, Any] | None:
         """
-        DBから駅ランクを取得する。
+        駅ランクを取得する。
+        起動時に一括ロードし apply_station_rank で更新しているキャッシュを参照するため、
+        駅ごとに DB へ問い合わせない。
         """
-        with SessionLocal() as db:
-            r = db.query(StationRank).filter(StationRank.station_id == station_id).first()
-            if not r:
-                return None
-            return {"rank": r.rank, "dwell_time": r.dwell_time}
+        cached = self.station_rank_cache.get(station_id)
+        if cached is None:
+            return None
+        return {"rank": cached["rank"], "dwell_time": cached["dwell_time"]}
 
     def get_station_dwell_time(self, station_id: str | None) -> int:
         """
@@ -662,6 +730,7 @@ class DataCache:
     def load_station_positions_from_db(self) -> None:
         """DBから駅座標キャッシュを構築する (Step 2)"""
         self.station_positions.clear()
+        self.station_latlon.clear()
         with SessionLocal() as db:
             # 高速化のため必要なカラムのみ取得
             rows = db.query(Station.id, Station.lon, Station.lat).all()
@@ -672,6 +741,7 @@ class DataCache:
                 if not _is_valid_coord(lon, lat):
                     continue
                 self.station_positions[s_id] = (lon, lat)
+                self.station_latlon[s_id] = (lat, lon)
         
         logger.info("Loaded %d station positions from DB", len(self.station_positions))
 
@@ -695,6 +765,7 @@ class DataCache:
         DBから全駅情報を取得し、検索に使いやすい形式でキャッシュする。
         """
         self.station_search_index.clear()
+        self._coord_by_name_cache.clear()
 
         with SessionLocal() as db:
             rows = db.query(
@@ -735,6 +806,81 @@ class DataCache:
 
         logger.info("Built station search index with %d stations", len(self.station_search_index))
 
+    def build_line_summary_index(self) -> None:
+        """
+        /api/lines のレスポンス形式に変換済みの路線リストを構築する。
+        事業者IDごとのリストも作り、?operator= の絞り込みを dict 参照で済ませる。
+        """
+        self.line_summaries = []
+        self.line_summaries_by_operator = {}
+
+        for raw in self.railways:
+            title = raw.get("title", {})
+            line_id = raw.get("id", "")
+            operator_id = line_id.split(".")[0] if "." in line_id else ""
+            summary = {
+                "id": line_id,
+                "name_ja": title.get("ja", ""),
+                "name_en": title.get("en", ""),
+                "color": raw.get("color", "#000000"),
+                "operator": operator_id,
+                "station_count": len(raw.get("stations", [])),
+            }
+            self.line_summaries.append(summary)
+            if operator_id:
+                self.line_summaries_by_operator.setdefault(operator_id, []).append(summary)
+
+    def build_station_api_index(self) -> None:
+        """
+        /api/stations のレスポンス形式に変換済みの駅リストを路線ごとに構築する。
+        リクエストごとの DB クエリと dict 変換を不要にする。
+        """
+        self.stations_transformed_by_line.clear()
+        self._station_api_by_id.clear()
+
+        with SessionLocal() as db:
+            rows = db.query(
+                Station.id,
+                Station.line_id,
+                Station.name_ja,
+                Station.name_en,
+                Station.lon,
+                Station.lat
+            ).all()
+
+        for s_id, line_id, name_ja, name_en, lon, lat in rows:
+            rank_entry = self.station_rank_cache.get(s_id)
+            station = {
+                "id": s_id,
+                "line_id": line_id,
+                "name_ja": name_ja,
+                "name_en": name_en,
+                "coord": {"lon": lon, "lat": lat if lon is not None else None},
+                "rank": rank_entry["rank"] if rank_entry else "B",
+                "dwell_time": rank_entry["dwell_time"] if rank_entry else get_static_dwell_time(s_id),
+            }
+            self.stations_transformed_by_line.setdefault(line_id, []).append(station)
+            self._station_api_by_id[s_id] = station
+
+        logger.info(
+            "Built station API index: %d stations on %d lines",
+            len(self._station_api_by_id),
+            len(self.stations_transformed_by_line),
+        )
+
+    def apply_station_rank(self, station_id: str, rank: str, dwell_time: int) -> None:
+        """
+        更新済みの駅ランクをメモリ上のキャッシュ（ランクキャッシュ・駅APIインデックス）に反映する。
+        """
+        self.station_rank_cache[station_id] = {
+            "rank": rank,
+            "dwell_time": int(dwell_time),
+        }
+        station = self._station_api_by_id.get(station_id)
+        if station is not None:
+            station["rank"] = rank
+            station["dwell_time"] = int(dwell_time)
+
     def search_stations_by_name(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
         """
         駅名で駅を検索する（部分一致）。
@@ -776,15 +922,28 @@ class DataCache:
 
         Returns:
             (lat, lon) タプル。見つからない場合は None。
+
+        経路検索では同じ駅名が繰り返し指定されるため、線形探索の結果を
+        駅名ごとに覚えておく（見つからなかった場合の None も含む）。
         """
+        try:
+            return self._coord_by_name_cache[name]
+        except KeyError:
+            pass
+
+        result = None
         results = self.search_stations_by_name(name, limit=1)
         if results:
             coord = results[0].get("coord", {})
             lat = coord.get("lat")
             lon = coord.get("lon")
             if lat is not None and lon is not None:
-                return (lat, lon)
-        return None
+                result = (lat, lon)
+
+        if len(self._coord_by_name_cache) >= _COORD_BY_NAME_CACHE_MAX:
+            self._coord_by_name_cache.clear()
+        self._coord_by_name_cache[name] = result
+        return result
 
     def get_station_coord(self, station_id: str) -> tuple[float, float] | None:
         """
@@ -809,7 +968,4 @@ class DataCache:
             db.commit()
             logger.info(f"Updated station rank for {station_id}: rank={rank}, dwell={dwell_time}")
 
-        self.station_rank_cache[station_id] = {
-            "rank": rank,
-            "dwell_time": int(dwell_time),
-        }
+        self.apply_station_rank(station_id, rank, dwell_time)
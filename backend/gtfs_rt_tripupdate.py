@@ -6,6 +6,7 @@ MS1: リアルタイム駅時刻テーブルへの正規化を行う。
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 from dataclasses import dataclass, field
 from datetime import datetime
@@ -21,6 +22,7 @@ from constants import (
     HTTP_TIMEOUT,
 )
 from gtfs_rt_vehicle import is_yamanote, get_direction, get_train_number, identify_routes_by_trip_id
+from singleflight import SingleFlight
 from train_state import determine_service_type
 
 if TYPE_CHECKING:
@@ -29,12 +31,19 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 JST = ZoneInfo("Asia/Tokyo")
 
+# 全路線の v4 / デバッグ API が同じフィードを取りに行くので、
+# 同時・直後の呼び出しは1回の取得と protobuf 解析にまとめる
+TRIP_UPDATE_CACHE_TTL_SEC = 1.5
+_feed_flight = SingleFlight(ttl=TRIP_UPDATE_CACHE_TTL_SEC)
+# 路線ごとに正規化した結果も同じ TTL で共有する（経路検索・デバッグ API の同時呼び出し用）
+_schedules_flight = SingleFlight(ttl=TRIP_UPDATE_CACHE_TTL_SEC)
+
 
 # ============================================================================
 # Data Models
 # ============================================================================
 
-@dataclass
+@dataclass(slots=True)
 class RealtimeStationSchedule:
     """1駅分のリアルタイム到着・発車時刻情報"""
     stop_sequence: int
@@ -46,7 +55,7 @@ class RealtimeStationSchedule:
     delay: int = 0                   # MS6: 遅延秒数 (デフォルト0)
 
 
-@dataclass
+@dataclass(slots=True)
 class TrainSchedule:
     """1本の列車のリアルタイム時刻テーブル"""
     trip_id: str                     # 主キー
@@ -56,32 +65,39 @@ class TrainSchedule:
     feed_timestamp: Optional[int]    # feed.header.timestamp
     schedules_by_seq: Dict[int, RealtimeStationSchedule] = field(default_factory=dict)
     ordered_sequences: List[int] = field(default_factory=list)
+    resolved_count: int = 0          # schedules_by_seq のうち station_id を解決できた駅数
 
 
 # ============================================================================
 # Fetch Function
 # ============================================================================
 
-async def fetch_trip_updates(
+async def fetch_trip_update_feed(
     client: httpx.AsyncClient,
     api_key: str,
-    data_cache: "DataCache",
-    target_route_id: str = YAMANOTE_ROUTE_ID,  # MS10: デフォルトで後方互換性維持
-    mt3d_prefix: str = None,  # MS11: 駅IDプレフィックス (e.g., "JR-East.ChuoRapid")
-) -> Dict[str, TrainSchedule]:
+) -> Optional[gtfs_realtime_pb2.FeedMessage]:
     """
-    GTFS-RT TripUpdate を取得し、列車ごとのリアルタイム駅時刻テーブルに正規化する。
+    GTFS-RT TripUpdate フィードを取得して protobuf を解析する。
+    
+    同時に来た呼び出しは1回の取得にまとめ、結果を TRIP_UPDATE_CACHE_TTL_SEC 秒だけ再利用する。
+    返す FeedMessage は呼び出し元間で共有されるので、読み取り専用として扱うこと。
     
     Args:
         client: httpx.AsyncClient インスタンス
         api_key: ODPT API key
-        data_cache: 静的データキャッシュ
         
     Returns:
-        {trip_id: TrainSchedule} の辞書
+        FeedMessage。取得・解析に失敗した場合は None
+        （失敗も TTL の間は共有し、障害中の ODPT へ再試行を集中させない）
     """
-    results: Dict[str, TrainSchedule] = {}
-    
+    return await _feed_flight.run(api_key, lambda: _fetch_trip_update_feed(client, api_key))
+
+
+async def _fetch_trip_update_feed(
+    client: httpx.AsyncClient,
+    api_key: str,
+) -> Optional[gtfs_realtime_pb2.FeedMessage]:
+    """fetch_trip_update_feed の実処理（キャッシュなし）"""
     # 1. APIリクエスト
     try:
         url = f"{TRIP_UPDATE_URL}?acl:consumerKey={api_key}"
@@ -90,18 +106,87 @@ async def fetch_trip_updates(
         content = response.content
     except httpx.HTTPError as e:
         logger.error(f"Failed to fetch TripUpdate: {e}")
-        return {}
+        return None
     except Exception as e:
         logger.error(f"Unexpected error fetching TripUpdate: {e}")
-        return {}
+        return None
     
-    # 2. Protobuf解析
+    # 2. Protobuf解析（CPU処理なのでイベントループを塞がないようスレッドで実行）
     try:
         feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(content)
+        await asyncio.to_thread(feed.ParseFromString, content)
     except Exception as e:
         logger.error(f"Failed to parse TripUpdate protobuf: {e}")
+        return None
+    
+    return feed
+
+
+async def fetch_trip_updates(
+    client: httpx.AsyncClient,
+    api_key: str,
+    data_cache: "DataCache",
+    target_route_id: str = YAMANOTE_ROUTE_ID,  # MS10: デフォルトで後方互換性維持
+    mt3d_prefix: str = None,  # MS11: 駅IDプレフィックス (e.g., "JR-East.ChuoRapid")
+) -> Dict[str, TrainSchedule]:
+    """
+    GTFS-RT TripUpdate を取得し、列車ごとのリアルタイム駅時刻テーブルに正規化する。
+    
+    Args:
+        client: httpx.AsyncClient インスタンス
+        api_key: ODPT API key
+        data_cache: 静的データキャッシュ
+        
+    Returns:
+        {trip_id: TrainSchedule} の辞書
+        （TRIP_UPDATE_CACHE_TTL_SEC 秒間は呼び出し元間で共有されるので、読み取り専用として扱うこと）
+    """
+    key = (api_key, target_route_id, mt3d_prefix)
+    return await _schedules_flight.run(
+        key,
+        lambda: _fetch_trip_updates(client, api_key, data_cache, target_route_id, mt3d_prefix),
+    )
+
+
+async def _fetch_trip_updates(
+    client: httpx.AsyncClient,
+    api_key: str,
+    data_cache: "DataCache",
+    target_route_id: str,
+    mt3d_prefix: Optional[str],
+) -> Dict[str, TrainSchedule]:
+    """fetch_trip_updates の実処理（キャッシュなし）"""
+    feed = await fetch_trip_update_feed(client, api_key)
+    if feed is None:
         return {}
+    # 正規化は CPU 処理なのでイベントループを塞がないようスレッドで実行
+    return await asyncio.to_thread(
+        build_train_schedules, feed, data_cache, target_route_id, mt3d_prefix
+    )
+
+
+def build_train_schedules(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    data_cache: "DataCache",
+    target_route_id: str = YAMANOTE_ROUTE_ID,
+    mt3d_prefix: str = None,
+) -> Dict[str, TrainSchedule]:
+    """
+    解析済みの TripUpdate フィードから指定路線の列車を抽出し、
+    列車ごとのリアルタイム駅時刻テーブルに正規化する。
+    
+    同じフィードを複数路線で使い回せるよう、取得処理とは分けている。
+    
+    Args:
+        feed: fetch_trip_update_feed() の結果
+        data_cache: 静的データキャッシュ
+        target_route_id: 対象路線の GTFS route_id
+        mt3d_prefix: 駅IDプレフィックス (e.g., "JR-East.ChuoRapid")
+        
+    Returns:
+        {trip_id: TrainSchedule} の辞書
+    """
+    results: Dict[str, TrainSchedule] = {}
     
     feed_timestamp = feed.header.timestamp if feed.header.HasField("timestamp") else None
     logger.info(f"TripUpdate feed: {len(feed.entity)} entities, timestamp={feed_timestamp}")
@@ -113,6 +198,9 @@ async def fetch_trip_updates(
     # デバッグ用: route_id のサンプルを収集
     route_id_samples: List[str] = []
     
+    # 優先順位3 の駅解決で使う路線エントリ（路線IDインデックスから O(1) で取得）
+    railway = data_cache.railways_by_id.get(mt3d_prefix) if mt3d_prefix else None
+    
     # 3. エンティティを処理
     for entity in feed.entity:
         if not entity.HasField("trip_update"):
@@ -175,6 +263,7 @@ async def fetch_trip_updates(
         
         # 9. stop_time_update の展開
         schedules_by_seq: Dict[int, RealtimeStationSchedule] = {}
+        resolved_count = 0
         
         for stu in trip_update.stop_time_update:
             stop_seq = stu.stop_sequence
@@ -213,8 +302,7 @@ async def fetch_trip_updates(
             # 優先順位3 (MS11): mt3d_prefix から railways.json の駅リストを使用
             # GTFS-RT に stop_id が含まれない場合のフォールバック
             if not resolved and mt3d_prefix:
-                # data_cache.railways から該当路線の駅リストを取得
-                railway = next((r for r in data_cache.railways if r.get("id") == mt3d_prefix), None)
+                # 該当路線の railways.json エントリ（ループ外で1回だけ引いておく）
                 if railway:
                     stations_list = railway.get("stations", [])
                     # stop_sequence は 1-based と仮定
@@ -260,6 +348,12 @@ async def fetch_trip_updates(
                 if stu.schedule_relationship == gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED:
                     continue
             
+            previous = schedules_by_seq.get(stop_seq)
+            if previous is not None and previous.resolved:
+                resolved_count -= 1
+            if resolved:
+                resolved_count += 1
+            
             schedules_by_seq[stop_seq] = RealtimeStationSchedule(
                 stop_sequence=stop_seq,
                 station_id=station_id,
@@ -286,6 +380,7 @@ async def fetch_trip_updates(
             feed_timestamp=feed_timestamp,
             schedules_by_seq=schedules_by_seq,
             ordered_sequences=ordered_sequences,
+            resolved_count=resolved_count,
         )
     
     # デバッグ: route_id サンプル出力
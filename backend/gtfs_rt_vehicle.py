@@ -5,9 +5,17 @@ import os
 import re
 import httpx
 import asyncio
+from array import array
 from google.transit import gtfs_realtime_pb2
-from dataclasses import dataclass
-from typing import Optional, List
+from dataclasses import dataclass, field
+from typing import Iterator, Optional, List
+
+from singleflight import SingleFlight
+
+# 同時ポーリングをまとめるための single-flight（GTFS-RT の更新間隔より十分短い TTL）
+POSITIONS_CACHE_TTL_SEC = 2.0
+_positions_flight = SingleFlight(ttl=POSITIONS_CACHE_TTL_SEC)
+_positions_with_schedule_flight = SingleFlight(ttl=POSITIONS_CACHE_TTL_SEC)
 
 
 @dataclass
@@ -23,6 +31,70 @@ class YamanoteTrainPosition:
     timestamp: int
 
 
+@dataclass
+class YamanoteTrainPositionsBatch:
+    """
+    山手線の列車位置（列ごとに保持する SoA 形式）
+
+    数値列は array で連続領域に保持し、列車ごとの dataclass 生成を省く。
+    既存コード向けに len() / インデックス / イテレーションで
+    YamanoteTrainPosition を返す互換APIを持つ。
+    """
+    trip_ids: List[str] = field(default_factory=list)
+    train_numbers: List[str] = field(default_factory=list)
+    directions: List[str] = field(default_factory=list)
+    latitudes: array = field(default_factory=lambda: array('d'))
+    longitudes: array = field(default_factory=lambda: array('d'))
+    stop_sequences: array = field(default_factory=lambda: array('I'))
+    statuses: array = field(default_factory=lambda: array('B'))
+    timestamps: array = field(default_factory=lambda: array('Q'))
+
+    def __len__(self) -> int:
+        return len(self.trip_ids)
+
+    def __getitem__(self, i: int) -> YamanoteTrainPosition:
+        return YamanoteTrainPosition(
+            trip_id=self.trip_ids[i],
+            train_number=self.train_numbers[i],
+            direction=self.directions[i],
+            latitude=self.latitudes[i],
+            longitude=self.longitudes[i],
+            stop_sequence=self.stop_sequences[i],
+            status=self.statuses[i],
+            timestamp=self.timestamps[i],
+        )
+
+    def __iter__(self) -> Iterator[YamanoteTrainPosition]:
+        for i in range(len(self.trip_ids)):
+            yield self[i]
+
+    def to_api_dicts(self) -> List[dict]:
+        """
+        /api/trains/yamanote/positions の trains 配列（camelCase）を列から直接組み立てる。
+        列車ごとの YamanoteTrainPosition 生成を経由しない。
+        """
+        return [
+            {
+                "tripId": trip_id,
+                "trainNumber": train_number,
+                "direction": direction,
+                "latitude": latitude,
+                "longitude": longitude,
+                "stopSequence": stop_sequence,
+                "status": status,
+            }
+            for trip_id, train_number, direction, latitude, longitude, stop_sequence, status in zip(
+                self.trip_ids,
+                self.train_numbers,
+                self.directions,
+                self.latitudes,
+                self.longitudes,
+                self.stop_sequences,
+                self.statuses,
+            )
+        ]
+
+
 @dataclass
 class YamanoteTrainPositionWithSchedule:
     """山手線の列車位置（出発時刻付き）"""
@@ -38,10 +110,47 @@ class YamanoteTrainPositionWithSchedule:
     departure_time: Optional[int] = None  # 現在駅の出発時刻（UNIXタイムスタンプ）
     next_arrival_time: Optional[int] = None  # 次駅の到着時刻
 
+    def to_api_dict(self) -> dict:
+        """/api/trains/yamanote/positions/v2 の列車1件（camelCase）に変換する"""
+        return {
+            "tripId": self.trip_id,
+            "trainNumber": self.train_number,
+            "direction": self.direction,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "stopSequence": self.stop_sequence,
+            "status": self.status,
+            "departureTime": self.departure_time,
+            "nextArrivalTime": self.next_arrival_time,
+            "timestamp": self.timestamp,  # GTFS-RT更新時刻
+        }
+
+
+# 山手線の trip_id サフィックス
+YAMANOTE_SUFFIXES = frozenset('G')
+
 
 def is_yamanote(trip_id: str) -> bool:
     """山手線かどうか判定"""
-    return trip_id.endswith('G')
+    return trip_id[-1:] in YAMANOTE_SUFFIXES
+
+
+# trip_id サフィックス → 候補路線（呼び出しごとに再構築しないようモジュール定数にする）
+_SUFFIX_TO_ROUTES = {
+    'G': ["JR-East.Yamanote"],
+    'H': ["JR-East.ChuoRapid", "JR-East.Yokosuka"],
+    'T': ["JR-East.ChuoRapid"],
+    'A': ["JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"],
+    'B': ["JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"],
+    'C': ["JR-East.ChuoSobuLocal"],
+    'K': ["JR-East.Yokohama", "JR-East.SaikyoKawagoe"],
+    'F': ["JR-East.Nambu", "JR-East.SaikyoKawagoe", "JR-East.SobuRapid"],
+    'M': ["JR-East.Joban", "JR-East.JobanRapid", "JR-East.SaikyoKawagoe",
+          "JR-East.Keiyo", "JR-East.Tokaido", "JR-East.Sobu", "JR-East.SobuRapid"],
+    'Y': ["JR-East.Yokosuka", "JR-East.Keiyo", "JR-East.Tokaido", "JR-East.ChuoSobuLocal"],
+    'S': ["JR-East.SaikyoKawagoe", "JR-East.Yokosuka"],
+    'E': ["JR-East.Musashino", "JR-East.Tokaido"],
+}
 
 
 def identify_route_by_trip_id(trip_id: str) -> str | None:
@@ -76,25 +185,31 @@ def identify_routes_by_trip_id(trip_id: str) -> list[str]:
     if not trip_id:
         return []
 
-    suffix = trip_id[-1].upper() if trip_id else ""
+    return _SUFFIX_TO_ROUTES.get(trip_id[-1].upper(), [])
 
-    SUFFIX_TO_ROUTES = {
-        'G': ["JR-East.Yamanote"],
-        'H': ["JR-East.ChuoRapid", "JR-East.Yokosuka"],
-        'T': ["JR-East.ChuoRapid"],
-        'A': ["JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"],
-        'B': ["JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"],
-        'C': ["JR-East.ChuoSobuLocal"],
-        'K': ["JR-East.Yokohama", "JR-East.SaikyoKawagoe"],
-        'F': ["JR-East.Nambu", "JR-East.SaikyoKawagoe", "JR-East.SobuRapid"],
-        'M': ["JR-East.Joban", "JR-East.JobanRapid", "JR-East.SaikyoKawagoe",
-              "JR-East.Keiyo", "JR-East.Tokaido", "JR-East.Sobu", "JR-East.SobuRapid"],
-        'Y': ["JR-East.Yokosuka", "JR-East.Keiyo", "JR-East.Tokaido", "JR-East.ChuoSobuLocal"],
-        'S': ["JR-East.SaikyoKawagoe", "JR-East.Yokosuka"],
-        'E': ["JR-East.Musashino", "JR-East.Tokaido"],
-    }
 
-    return SUFFIX_TO_ROUTES.get(suffix, [])
+# 路線ごとの direction 名（静的時刻表データの direction 値に合わせる）
+_DIRECTION_MAP = {
+    # route_id: (奇数=下り, 偶数=上り)
+    "JR-East.Yamanote": ("OuterLoop", "InnerLoop"),
+    "JR-East.ChuoRapid": ("Outbound", "Inbound"),
+    "JR-East.KeihinTohokuNegishi": ("Southbound", "Northbound"),
+    "JR-East.ChuoSobuLocal": ("Westbound", "Eastbound"),
+    "JR-East.Yokohama": ("Outbound", "Inbound"),
+    "JR-East.SaikyoKawagoe": ("Northbound", "Southbound"),
+    "JR-East.Nambu": ("Outbound", "Inbound"),
+    "JR-East.Joban": ("Outbound", "Inbound"),
+    "JR-East.JobanRapid": ("Outbound", "Inbound"),
+    "JR-East.JobanLocal": ("Outbound", "Inbound"),
+    "JR-East.Keiyo": ("Outbound", "Inbound"),
+    "JR-East.Musashino": ("Outbound", "Inbound"),
+    "JR-East.SobuRapid": ("Outbound", "Inbound"),
+    "JR-East.Tokaido": ("Outbound", "Inbound"),
+    "JR-East.Yokosuka": ("Southbound", "Northbound"),
+    "JR-East.Takasaki": ("Outbound", "Inbound"),
+    "JR-East.Utsunomiya": ("Outbound", "Inbound"),
+    "JR-East.ShonanShinjuku": ("Southbound", "Northbound"),
+}
 
 
 def get_direction(trip_id: str, route_id: str = None) -> str:
@@ -135,36 +250,18 @@ def get_direction(trip_id: str, route_id: str = None) -> str:
     # route_id がある場合、路線ごとの direction 名にマッピング
     # 静的時刻表データの direction 値に合わせる
     # 奇数=下り(Outbound系), 偶数=上り(Inbound系)
-    DIRECTION_MAP = {
-        # route_id: (奇数=下り, 偶数=上り)
-        "JR-East.Yamanote": ("OuterLoop", "InnerLoop"),
-        "JR-East.ChuoRapid": ("Outbound", "Inbound"),
-        "JR-East.KeihinTohokuNegishi": ("Southbound", "Northbound"),
-        "JR-East.ChuoSobuLocal": ("Westbound", "Eastbound"),
-        "JR-East.Yokohama": ("Outbound", "Inbound"),
-        "JR-East.SaikyoKawagoe": ("Northbound", "Southbound"),
-        "JR-East.Nambu": ("Outbound", "Inbound"),
-        "JR-East.Joban": ("Outbound", "Inbound"),
-        "JR-East.JobanRapid": ("Outbound", "Inbound"),
-        "JR-East.JobanLocal": ("Outbound", "Inbound"),
-        "JR-East.Keiyo": ("Outbound", "Inbound"),
-        "JR-East.Musashino": ("Outbound", "Inbound"),
-        "JR-East.SobuRapid": ("Outbound", "Inbound"),
-        "JR-East.Tokaido": ("Outbound", "Inbound"),
-        "JR-East.Yokosuka": ("Southbound", "Northbound"),
-        "JR-East.Takasaki": ("Outbound", "Inbound"),
-        "JR-East.Utsunomiya": ("Outbound", "Inbound"),
-        "JR-East.ShonanShinjuku": ("Southbound", "Northbound"),
-    }
-    
-    if route_id and route_id in DIRECTION_MAP:
-        outbound, inbound = DIRECTION_MAP[route_id]
+    if route_id and route_id in _DIRECTION_MAP:
+        outbound, inbound = _DIRECTION_MAP[route_id]
         return outbound if is_odd else inbound
     
     # デフォルト
     return 'Outbound' if is_odd else 'Inbound'
 
 
+# 末尾の「3〜4桁の数字 + 英字1文字」
+_TRAIN_NUMBER_RE = re.compile(r'(\d{3,4})([A-Z])$')
+
+
 def get_train_number(trip_id: str) -> str:
     """
     Trip ID から列車番号を抽出する（正規化対応版）
@@ -178,11 +275,16 @@ def get_train_number(trip_id: str) -> str:
     Returns:
         正規化された列車番号 (例: "301G", "1103G")
     """
+    # 末尾が英大文字でなければ正規表現を使わずに返す
+    last = trip_id[-1:]
+    if len(trip_id) < 4 or not ('A' <= last <= 'Z'):
+        return trip_id
+
     # 末尾にある "3〜4桁の数字 + 英字1文字" を検索
     # (\d{3,4}) : 3桁または4桁の数字（山手線の列車番号は3〜4桁）
     # ([A-Z])   : 英字1文字 (G)
     # $         : 末尾
-    match = re.search(r'(\d{3,4})([A-Z])$', trip_id)
+    match = _TRAIN_NUMBER_RE.search(trip_id)
     
     if match:
         number_part = match.group(1)
@@ -198,58 +300,90 @@ def get_train_number(trip_id: str) -> str:
     return trip_id
 
 
-async def fetch_yamanote_positions(api_key: str) -> list[YamanoteTrainPosition]:
+def _parse_feed(content: bytes) -> gtfs_realtime_pb2.FeedMessage:
+    """GTFS-RT のバイト列を FeedMessage にデコードする"""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+
+def _yamanote_vehicles(feed) -> list:
+    """
+    FeedMessage から山手線の VehiclePosition だけを先に絞り込む。
+    内包表記の1パスで判定し、以降のループでは対象列車のみを扱う。
+
+    vehicle を持たない entity でも protobuf はデフォルト値（空の trip_id）を返すため、
+    HasField('vehicle') を呼ばずにサフィックス判定だけで除外できる。
+    """
+    return [
+        vp
+        for vp in (entity.vehicle for entity in feed.entity)
+        if vp.trip.trip_id[-1:] in YAMANOTE_SUFFIXES
+    ]
+
+
+def _parse_yamanote_positions(feed) -> YamanoteTrainPositionsBatch:
+    """FeedMessage を列ごとの YamanoteTrainPositionsBatch に変換する（async/sync 共通）"""
+    vehicles = _yamanote_vehicles(feed)
+    trip_ids = [vp.trip.trip_id for vp in vehicles]
+    
+    return YamanoteTrainPositionsBatch(
+        trip_ids=trip_ids,
+        train_numbers=[get_train_number(t) for t in trip_ids],
+        directions=[get_direction(t) for t in trip_ids],
+        latitudes=array('d', [vp.position.latitude for vp in vehicles]),
+        longitudes=array('d', [vp.position.longitude for vp in vehicles]),
+        stop_sequences=array('I', [vp.current_stop_sequence for vp in vehicles]),
+        statuses=array('B', [vp.current_status for vp in vehicles]),
+        timestamps=array('Q', [vp.timestamp for vp in vehicles]),
+    )
+
+
+async def fetch_yamanote_positions(
+    api_key: str,
+    client: httpx.AsyncClient | None = None,
+) -> YamanoteTrainPositionsBatch:
     """
     GTFS-RT VehiclePosition から山手線の列車位置を取得
     
+    同時に来た呼び出しは1回の取得にまとめ、結果を短時間再利用する。
+    
     Args:
         api_key: ODPT APIキー
+        client: 共有の httpx.AsyncClient（省略時はその場で作成）
     
     Returns:
-        山手線列車位置のリスト
+        山手線列車位置（列ごとの SoA 形式）
     """
+    return await _positions_flight.run(api_key, lambda: _fetch_yamanote_positions(api_key, client))
+
+
+async def _fetch_yamanote_positions(
+    api_key: str,
+    client: httpx.AsyncClient | None = None,
+) -> YamanoteTrainPositionsBatch:
+    """fetch_yamanote_positions の実処理（キャッシュなし）"""
+    if client is None:
+        async with httpx.AsyncClient() as own_client:
+            return await _fetch_yamanote_positions(api_key, own_client)
+    
     url = "https://api-challenge.odpt.org/api/v4/gtfs/realtime/jreast_odpt_train_vehicle"
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            url,
-            params={"acl:consumerKey": api_key},
-            timeout=30.0
-        )
-        response.raise_for_status()
+    response = await client.get(
+        url,
+        params={"acl:consumerKey": api_key},
+        timeout=30.0
+    )
+    response.raise_for_status()
     
     feed = gtfs_realtime_pb2.FeedMessage()
     feed.ParseFromString(response.content)
     
-    positions = []
-    
-    for entity in feed.entity:
-        if not entity.HasField('vehicle'):
-            continue
-        
-        vp = entity.vehicle
-        trip_id = vp.trip.trip_id
-        
-        # 山手線フィルタ
-        if not is_yamanote(trip_id):
-            continue
-        
-        positions.append(YamanoteTrainPosition(
-            trip_id=trip_id,
-            train_number=get_train_number(trip_id),
-            direction=get_direction(trip_id),
-            latitude=vp.position.latitude,
-            longitude=vp.position.longitude,
-            stop_sequence=vp.current_stop_sequence,
-            status=vp.current_status,
-            timestamp=vp.timestamp
-        ))
-    
-    return positions
+    return _parse_yamanote_positions(feed)
 
 
 # 同期版（テスト用）
-def fetch_yamanote_positions_sync(api_key: str) -> list[YamanoteTrainPosition]:
+def fetch_yamanote_positions_sync(api_key: str) -> YamanoteTrainPositionsBatch:
     """同期版の位置取得"""
     import requests
     
@@ -265,96 +399,86 @@ def fetch_yamanote_positions_sync(api_key: str) -> list[YamanoteTrainPosition]:
     feed = gtfs_realtime_pb2.FeedMessage()
     feed.ParseFromString(response.content)
     
-    positions = []
-    
-    for entity in feed.entity:
-        if not entity.HasField('vehicle'):
-            continue
-        
-        vp = entity.vehicle
-        trip_id = vp.trip.trip_id
-        
-        if not is_yamanote(trip_id):
-            continue
-        
-        positions.append(YamanoteTrainPosition(
-            trip_id=trip_id,
-            train_number=get_train_number(trip_id),
-            direction=get_direction(trip_id),
-            latitude=vp.position.latitude,
-            longitude=vp.position.longitude,
-            stop_sequence=vp.current_stop_sequence,
-            status=vp.current_status,
-            timestamp=vp.timestamp
-        ))
-    
-    return positions
+    return _parse_yamanote_positions(feed)
 
 
-async def fetch_yamanote_positions_with_schedule(api_key: str) -> list[YamanoteTrainPositionWithSchedule]:
+async def fetch_yamanote_positions_with_schedule(
+    api_key: str,
+    client: httpx.AsyncClient | None = None,
+) -> list[YamanoteTrainPositionWithSchedule]:
     """
     VehiclePosition と TripUpdate を統合して、出発時刻付きの位置情報を返す
+    
+    同時に来た呼び出しは1回の取得にまとめ、結果を短時間再利用する。
+    client を渡すと共有の接続プールを使う（省略時はその場で作成）。
     """
+    return await _positions_with_schedule_flight.run(
+        api_key, lambda: _fetch_yamanote_positions_with_schedule(api_key, client)
+    )
+
+
+async def _fetch_yamanote_positions_with_schedule(
+    api_key: str,
+    client: httpx.AsyncClient | None = None,
+) -> list[YamanoteTrainPositionWithSchedule]:
+    """fetch_yamanote_positions_with_schedule の実処理（キャッシュなし）"""
+    if client is None:
+        async with httpx.AsyncClient() as own_client:
+            return await _fetch_yamanote_positions_with_schedule(api_key, own_client)
+    
     # 1. VehiclePosition を取得
     vehicle_url = "https://api-challenge.odpt.org/api/v4/gtfs/realtime/jreast_odpt_train_vehicle"
     
     # 2. TripUpdate を取得
     trip_update_url = "https://api-challenge.odpt.org/api/v4/gtfs/realtime/jreast_odpt_train_trip_update"
     
-    async with httpx.AsyncClient() as client:
-        vehicle_resp, trip_resp = await asyncio.gather(
-            client.get(vehicle_url, params={"acl:consumerKey": api_key}, timeout=30.0),
-            client.get(trip_update_url, params={"acl:consumerKey": api_key}, timeout=30.0),
-        )
-    
-    # VehiclePosition をパース
-    vehicle_feed = gtfs_realtime_pb2.FeedMessage()
-    vehicle_feed.ParseFromString(vehicle_resp.content)
+    vehicle_resp, trip_resp = await asyncio.gather(
+        client.get(vehicle_url, params={"acl:consumerKey": api_key}, timeout=30.0),
+        client.get(trip_update_url, params={"acl:consumerKey": api_key}, timeout=30.0),
+    )
     
-    # TripUpdate をパースしてマップ化
-    trip_feed = gtfs_realtime_pb2.FeedMessage()
-    trip_feed.ParseFromString(trip_resp.content)
+    # VehiclePosition / TripUpdate のパースはCPU処理なのでスレッドプールで並行実行し、
+    # イベントループを塞がないようにする
+    vehicle_feed, trip_feed = await asyncio.gather(
+        asyncio.to_thread(_parse_feed, vehicle_resp.content),
+        asyncio.to_thread(_parse_feed, trip_resp.content),
+    )
     
-    # trip_id → {stop_sequence: {arrival, departure}} のマップ
+    # TripUpdate をマップ化
+    # trip_id → {stop_sequence: (arrival, departure)} のマップ
     trip_schedules = {}
     for entity in trip_feed.entity:
-        if not entity.HasField('trip_update'):
-            continue
+        # trip_update が無い entity は trip_id が空文字になり、ここで除外される
         tu = entity.trip_update
         trip_id = tu.trip.trip_id
-        if not is_yamanote(trip_id):
+        if trip_id[-1:] not in YAMANOTE_SUFFIXES:
             continue
         
-        schedules = {}
-        for stu in tu.stop_time_update:
-            schedules[stu.stop_sequence] = {
-                'arrival': stu.arrival.time if stu.HasField('arrival') else None,
-                'departure': stu.departure.time if stu.HasField('departure') else None,
-            }
-        trip_schedules[trip_id] = schedules
+        trip_schedules[trip_id] = {
+            stu.stop_sequence: (
+                stu.arrival.time if stu.HasField('arrival') else None,
+                stu.departure.time if stu.HasField('departure') else None,
+            )
+            for stu in tu.stop_time_update
+        }
     
     # VehiclePosition と TripUpdate を統合
     positions = []
-    for entity in vehicle_feed.entity:
-        if not entity.HasField('vehicle'):
-            continue
-        
-        vp = entity.vehicle
+    for vp in _yamanote_vehicles(vehicle_feed):
         trip_id = vp.trip.trip_id
         
-        if not is_yamanote(trip_id):
-            continue
-        
         # TripUpdate から出発時刻を取得
         departure_time = None
         next_arrival_time = None
-        if trip_id in trip_schedules:
+        schedules = trip_schedules.get(trip_id)
+        if schedules:
             current_seq = vp.current_stop_sequence
-            if current_seq in trip_schedules[trip_id]:
-                departure_time = trip_schedules[trip_id][current_seq].get('departure')
-            next_seq = current_seq + 1
-            if next_seq in trip_schedules[trip_id]:
-                next_arrival_time = trip_schedules[trip_id][next_seq].get('arrival')
+            current = schedules.get(current_seq)
+            if current:
+                departure_time = current[1]
+            nxt = schedules.get(current_seq + 1)
+            if nxt:
+                next_arrival_time = nxt[0]
         
         positions.append(YamanoteTrainPositionWithSchedule(
             trip_id=trip_id,
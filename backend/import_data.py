@@ -2,8 +2,15 @@
 import json
 import logging
 from pathlib import Path
+from typing import Any, Dict, List
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 
+try:
+    import orjson  # 高速JSONパーサ（任意依存）
+except ImportError:
+    orjson = None
+
 # backendパッケージとして実行されることを想定 (python -m backend.import_data)
 from .database import SessionLocal, init_db, Station, StationRank
 from .station_ranks import STATION_RANKS
@@ -11,15 +18,44 @@ from .station_ranks import STATION_RANKS
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# プロジェクトルート (NowTrain-v2/) からのパスを一度だけ解決しておく
+BASE_DIR = Path(__file__).resolve().parent.parent
+STATIONS_JSON_PATH = BASE_DIR / "data" / "mini-tokyo-3d" / "stations.json"
+
+def _bulk_upsert(db: Session, model, rows: List[Dict[str, Any]]) -> None:
+    """
+    rows をまとめて upsert する。
+    SQLite では INSERT ... ON CONFLICT DO UPDATE を1つのステートメントで executemany し、
+    行ごとの SELECT → INSERT/UPDATE 往復（db.merge）を避ける。
+    """
+    if not rows:
+        return
+
+    if db.get_bind().dialect.name != "sqlite":
+        # 他DB向けのフォールバック
+        for row in rows:
+            db.merge(model(**row))
+        return
+
+    table = model.__table__
+    pk_cols = [c.name for c in table.primary_key.columns]
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=pk_cols,
+        set_={c.name: stmt.excluded[c.name] for c in table.columns if c.name not in pk_cols},
+    )
+    db.execute(stmt, rows)
+
 def import_stations(db: Session, json_path: Path):
     if not json_path.exists():
         logger.error(f"File not found: {json_path}")
         return
 
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(json_path, "rb") as f:
+        raw = f.read()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
 
-    count = 0
+    rows: List[Dict[str, Any]] = []
     for item in data:
         # JSON fields
         s_id = item.get("id")
@@ -47,25 +83,22 @@ def import_stations(db: Session, json_path: Path):
             lon = float(coord[0])
             lat = float(coord[1])
 
-        # Model instance
-        station = Station(
-            id=s_id,
-            line_id=line_id,
-            name_ja=title.get("ja"),
-            name_en=title.get("en"),
-            lon=lon,
-            lat=lat,
-        )
-        
-        # Upsert (merge)
-        db.merge(station)
-        count += 1
-    
+        rows.append({
+            "id": s_id,
+            "line_id": line_id,
+            "name_ja": title.get("ja"),
+            "name_en": title.get("en"),
+            "lon": lon,
+            "lat": lat,
+        })
+
+    # Upsert (bulk)
+    _bulk_upsert(db, Station, rows)
     db.commit()
-    logger.info(f"Imported/Updated {count} stations.")
+    logger.info(f"Imported/Updated {len(rows)} stations.")
 
 def import_ranks(db: Session):
-    count = 0
+    rows: List[Dict[str, Any]] = []
     for s_id, dwell in STATION_RANKS.items():
         # Rank判定 (簡易ロジック: 50=S, 35=A, 20=B, check definition)
         # station_ranks.py comments:
@@ -78,16 +111,15 @@ def import_ranks(db: Session):
         elif dwell >= 35:
             rank_char = "A"
         
-        rank_obj = StationRank(
-            station_id=s_id,
-            rank=rank_char,
-            dwell_time=dwell
-        )
-        db.merge(rank_obj)
-        count += 1
-        
+        rows.append({
+            "station_id": s_id,
+            "rank": rank_char,
+            "dwell_time": dwell,
+        })
+
+    _bulk_upsert(db, StationRank, rows)
     db.commit()
-    logger.info(f"Imported/Updated {count} station ranks.")
+    logger.info(f"Imported/Updated {len(rows)} station ranks.")
 
 def main():
     logger.info("Initializing database...")
@@ -96,10 +128,8 @@ def main():
     db = SessionLocal()
     try:
         # 1. Stations
-        # プロジェクトルートからの相対パス
-        stations_json_path = Path("data/mini-tokyo-3d/stations.json")
-        logger.info(f"Importing stations from {stations_json_path}...")
-        import_stations(db, stations_json_path)
+        logger.info(f"Importing stations from {STATIONS_JSON_PATH}...")
+        import_stations(db, STATIONS_JSON_PATH)
         
         # 2. Ranks
         logger.info("Importing station ranks...")
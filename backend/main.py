@@ -1,51 +1,118 @@
 # backend/main.py
 from __future__ import annotations
 
-from fastapi import FastAPI, HTTPException, Query, Depends
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from pathlib import Path
 from dotenv import load_dotenv
+import asyncio
+import hashlib
 import os
+import json
 import logging
-from typing import Any, Dict, List, Optional
-from dataclasses import asdict
-from pydantic import BaseModel
+import math
+import time
+from typing import Any, Dict, List, Literal, Optional, Tuple
+from dataclasses import dataclass, fields, is_dataclass
+from collections import Counter, defaultdict
+from itertools import repeat
+from operator import attrgetter
+from pydantic import BaseModel, Field
 
 import httpx
-from datetime import datetime
-from zoneinfo import ZoneInfo
 from sqlalchemy.orm import Session
 
 from data_cache import DataCache
-from config import get_line_config  # MS10: 路線設定のインポート
+from singleflight import SingleFlight
+from config import get_line_config, LineConfig, SUPPORTED_LINES  # MS10: 路線設定のインポート
 from database import SessionLocal, StationRank
 
+try:
+    import orjson  # 高速JSONエンコーダ（任意依存）
+except ImportError:
+    orjson = None
+
+try:
+    import h2  # httpx の HTTP/2 サポートに必要（任意依存）
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+
+def _json_default(obj: Any) -> Any:
+    """json 用のフォールバック: dataclass を dict に展開する（orjson はネイティブ対応）"""
+    if is_dataclass(obj):
+        return {f.name: getattr(obj, f.name) for f in fields(obj)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps_json(payload: Any) -> bytes:
+    """レスポンス本文を JSON バイト列にエンコードする（orjson が無ければ json）"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(
+        payload, ensure_ascii=False, separators=(",", ":"), default=_json_default
+    ).encode("utf-8")
+
+
+class _StdJSONResponse(JSONResponse):
+    """orjson が無い環境用: dataclass の行もそのままエンコードできる JSONResponse"""
+
+    def render(self, content: Any) -> bytes:
+        return _dumps_json(content)
+
+
+# 列車位置など大きなレスポンス用（orjson が無ければ標準の json でエンコード）
+FastJSONResponse = ORJSONResponse if orjson is not None else _StdJSONResponse
+
+
 # OTP クライアント（経路検索用）
 try:
-    from otp_client import search_route as otp_search_route, parse_otp_response, extract_trip_ids
+    from otp_client import search_route as otp_search_route, parse_otp_response, extract_trip_ids, TRANSIT_MODES
 except ImportError as e:
     logging.warning(f"OTP client import failed: {e}. Route search will not work.")
     otp_search_route = None
     parse_otp_response = None
     extract_trip_ids = None
+    TRANSIT_MODES = frozenset()
 
 # GTFS解析 & 列車位置計算 (MS11: 汎用化)
 try:
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    from train_position_v4 import compute_all_progress, calculate_coordinates
+    from gtfs_rt_vehicle import fetch_yamanote_positions, fetch_yamanote_positions_with_schedule
+    from gtfs_rt_tripupdate import fetch_trip_updates, fetch_trip_update_feed, build_train_schedules
+    from train_position_v4 import compute_all_progress, calculate_coordinates, get_track_polyline
 except ImportError as e:
     logging.warning(f"Module import failed: {e}. V4 API will not work.")
+    fetch_yamanote_positions = None
+    fetch_yamanote_positions_with_schedule = None
     fetch_trip_updates = None
+    fetch_trip_update_feed = None
+    build_train_schedules = None
     compute_all_progress = None
     calculate_coordinates = None
+    get_track_polyline = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-JST = ZoneInfo("Asia/Tokyo")
 
 load_dotenv()
 
-app = FastAPI()
+# ODPT API キー（.env 読み込み後に一度だけ取得する。変更時はサーバー再起動が必要）
+ODPT_API_KEY = os.getenv("ODPT_API_KEY", "").strip()
+
+
+def require_api_key() -> str:
+    """
+    ODPT API キーを返す依存関数。
+
+    未設定の場合はハンドラ本体に入る前に 503 を返し、レスポンス組み立てを省く。
+    """
+    if not ODPT_API_KEY:
+        raise HTTPException(status_code=503, detail="ODPT_API_KEY not set")
+    return ODPT_API_KEY
 
 BASE_DIR = Path(__file__).resolve().parent.parent  # NowTrain-v2/
 DATA_DIR = BASE_DIR / "data"
@@ -60,51 +127,96 @@ def get_db():
         db.close()
 
 class StationRankUpdate(BaseModel):
-    rank: str
-    dwell_time: int
+    # 値の検証はリクエスト本文の解析時に pydantic が行う（不正なら 422）
+    rank: Literal["S", "A", "B"]
+    dwell_time: int = Field(ge=0)
 
 
 # MS11: ID解決用ヘルパー関数
+# 路線ID → MiniTokyo3D ID（SUPPORTED_LINES は起動後に変わらないため import 時に構築）
+_MT3D_ID_BY_LINE: Dict[str, str] = {
+    line_id: conf.mt3d_id for line_id, conf in SUPPORTED_LINES.items()
+}
+
+# 未対応路線の 404 メッセージに載せる路線一覧（先頭10件）も import 時に一度だけ作る
+_SUPPORTED_LINES_SORTED_HEAD = ", ".join(sorted(SUPPORTED_LINES)[:10]) + "..."
+
+
 def resolve_line_id(input_id: str) -> str:
     """
     chuo_rapid -> JR-East.ChuoRapid のようにIDを変換する。
     設定がない場合はそのまま返す。
     """
-    conf = get_line_config(input_id)
-    if conf:
-        return conf.mt3d_id
-    return input_id
+    return _MT3D_ID_BY_LINE.get(input_id, input_id)
 
 
-@app.on_event("startup")
-async def startup_event():
+def _check_protobuf_backend() -> None:
+    """
+    protobuf の実装（upb / cpp / python）を確認する。
+    pure-Python 実装だと GTFS-RT の解析が大幅に遅くなるため警告を出す。
+    """
+    try:
+        from google.protobuf.internal import api_implementation
+    except ImportError:
+        return
+
+    impl = api_implementation.Type()
+    if impl == "python":
+        logger.warning(
+            "protobuf is using the pure-Python backend; GTFS-RT parsing will be slow. "
+            "Install protobuf>=4.21 (upb) or set PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp."
+        )
+    else:
+        logger.info("protobuf backend: %s", impl)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- startup ---
+    _check_protobuf_backend()
     data_cache.load_all()
     logger.info(
         "Data loaded: %d railways, %d stations",
         len(data_cache.railways),
         len(data_cache.stations),
     )
+    _warm_shape_cache()
+    _warm_track_polylines()
     # MS1-TripUpdate: httpx.AsyncClient を作成
-    app.state.http_client = httpx.AsyncClient()
+    # ポーリングが集中しても接続を使い回せるようプールを広げ、HTTP/2 で多重化する
+    app.state.http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=50,
+            keepalive_expiry=30.0,
+        ),
+        http2=_HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(10.0, connect=3.0),
+    )
     logger.info("httpx.AsyncClient initialized")
 
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    # MS1-TripUpdate: httpx.AsyncClient をクローズ
-    if hasattr(app.state, "http_client"):
+    try:
+        yield
+    finally:
+        # --- shutdown ---
+        # MS1-TripUpdate: httpx.AsyncClient をクローズ
         await app.state.http_client.aclose()
         logger.info("httpx.AsyncClient closed")
 
 
+# 全エンドポイントのレスポンスを orjson でエンコードする（未導入なら標準の JSONResponse）
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+
 # CORS 設定
 _default_origins = "http://localhost:5173,http://localhost:5174"  # 5174を追加
 _raw_origins = os.getenv("FRONTEND_URL", _default_origins)
-frontend_urls = [
+# CORSMiddleware はリクエストごとに `origin in allow_origins` を評価するので集合にしておく
+frontend_urls = frozenset(
     origin.strip()
     for origin in _raw_origins.split(",")
     if origin.strip()
-]
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -112,55 +224,108 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # プリフライト結果をブラウザに長めに覚えさせ、OPTIONS の往復を減らす（Chromium の上限は 2 時間）
+    max_age=7200,
 )
 
+# 線路形状・列車位置の JSON は繰り返しが多く gzip がよく効く
+# 列車位置は毎回圧縮し直すので、圧縮率より CPU を優先してレベルを下げる
+# （既定の 9 と比べてサイズはほぼ変わらず、圧縮時間は大きく減る）
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 
 @app.get("/api/health")
 async def health():
     return {"status": "ok"}
 
 
+# 静的データ（路線・線路形状）は実行中に変わらないので長めにキャッシュさせる
+STATIC_CACHE_CONTROL = "public, max-age=3600"
+# 駅一覧はランク更新で変わるため、毎回 ETag で再検証させる
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def _make_etag(body: bytes) -> str:
+    """エンコード済みレスポンス本文から強い ETag を作る"""
+    return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match に etag（または *）が含まれるか"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag == etag or tag == "W/" + etag:
+            return True
+    return False
+
+
+def _cached_json_response(
+    request: Request, cached: Tuple[bytes, str], cache_control: str
+) -> Response:
+    """
+    (本文, ETag) からレスポンスを返す。
+    クライアントが同じ ETag を持っていれば本文なしの 304 を返す。
+    """
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# /api/lines のエンコード済みレスポンス本文と ETag（キー: operator、None は全路線）
+_LINES_BODY_CACHE: Dict[Optional[str], Tuple[bytes, str]] = {}
+
+
 @app.get("/api/lines")
-async def get_lines(operator: Optional[str] = None):
+async def get_lines(request: Request, operator: Optional[str] = None):
     logger.info("GET /api/lines called with operator=%s", operator)
 
-    lines = data_cache.railways
+    operator = operator or None
+    cached = _LINES_BODY_CACHE.get(operator)
+    if cached is None:
+        # 起動時に構築済みの要約リストを一度だけエンコードする
+        if operator:
+            lines = data_cache.line_summaries_by_operator.get(operator, [])
+            # TODO (MS6): operators.json を使った厳密な事業者フィルタを検討
+        else:
+            lines = data_cache.line_summaries
+        body = _dumps_json({"lines": lines})
+        cached = (body, _make_etag(body))
+        # 未知の operator はキャッシュしない（任意文字列でキャッシュが膨らまないように）
+        if operator is None or operator in data_cache.line_summaries_by_operator:
+            _LINES_BODY_CACHE[operator] = cached
 
-    if operator:
-        prefix = operator + "."
-        lines = [l for l in lines if l.get("id", "").startswith(prefix)]
-        # TODO (MS6): operators.json を使った厳密な事業者フィルタを検討
+    return _cached_json_response(request, cached, STATIC_CACHE_CONTROL)
 
-    def to_line_summary(raw: Dict[str, Any]) -> Dict[str, Any]:
-        title = raw.get("title", {})
-        station_ids = raw.get("stations", [])
-        line_id = raw.get("id", "")
-        operator_id = line_id.split(".")[0] if "." in line_id else ""
-        return {
-            "id": line_id,
-            "name_ja": title.get("ja", ""),
-            "name_en": title.get("en", ""),
-            "color": raw.get("color", "#000000"),
-            "operator": operator_id,
-            "station_count": len(station_ids),
-        }
 
-    return {"lines": [to_line_summary(l) for l in lines]}
+# /api/lines/{line_id} のエンコード済みレスポンス本文と ETag（キー: 解決後の路線ID）
+_LINE_BODY_CACHE: Dict[str, Tuple[bytes, str]] = {}
 
 
 @app.get("/api/lines/{line_id}")
-async def get_line(line_id: str):
+async def get_line(request: Request, line_id: str):
     logger.info("GET /api/lines/%s", line_id)
 
     # MS11: ID解決
     target_id = resolve_line_id(line_id)
 
-    raw = next((l for l in data_cache.railways if l.get("id") == target_id), None)
-    if not raw:
-        raise HTTPException(status_code=404, detail=f"Line not found: {line_id} (resolved: {target_id})")
-    if not raw:
-        raise HTTPException(status_code=404, detail=f"Line not found: {line_id} (resolved: {target_id})")
+    cached = _LINE_BODY_CACHE.get(target_id)
+    if cached is None:
+        raw = data_cache.railways_by_id.get(target_id)
+        if not raw:
+            raise HTTPException(status_code=404, detail=f"Line not found: {line_id} (resolved: {target_id})")
+        body = _dumps_json(_line_detail(target_id, raw))
+        cached = _LINE_BODY_CACHE[target_id] = (body, _make_etag(body))
+
+    return _cached_json_response(request, cached, STATIC_CACHE_CONTROL)
+
 
+def _line_detail(target_id: str, raw: Dict[str, Any]) -> Dict[str, Any]:
+    """railways.json の1路線を /api/lines/{line_id} のレスポンス形式に変換する"""
     title = raw.get("title", {})
     operator_id = target_id.split(".")[0] if "." in target_id else ""
 
@@ -177,8 +342,14 @@ async def get_line(line_id: str):
     }
 
 
+# /api/stations のエンコード済みレスポンス本文と ETag（キー: 解決後の路線ID）
+# 駅ランク更新時に破棄する
+_STATIONS_BODY_CACHE: Dict[str, Tuple[bytes, str]] = {}
+
+
 @app.get("/api/stations")
 async def get_stations(
+    request: Request,
     lineId: Optional[str] = None, 
     line_id: Optional[str] = None  # エイリアス対応
 ):
@@ -193,38 +364,20 @@ async def get_stations(
     target_id = resolve_line_id(target_param)
     logger.info(f"Resolving Stations ID: '{target_param}' -> '{target_id}'")
 
-    # 3. データ検索 (FROM DB)
-    exists = any(l.get("id") == target_id for l in data_cache.railways)
-    if not exists:
+    # 3. データ検索
+    if target_id not in data_cache.railways_by_id:
         logger.warning(f"Station lookup failed: Line ID '{target_id}' not found in railways.")
         raise HTTPException(status_code=404, detail=f"Line not found: {target_param} -> {target_id}")
 
-    stations = data_cache.get_stations_by_line(target_id)
-    logger.info(f"Found {len(stations)} stations for {target_id} (from DB)")
-
-    def to_station(raw: Dict[str, Any]) -> Dict[str, Any]:
-        title = raw.get("title", {})
-        coord_raw = raw.get("coord")
-        lon, lat = None, None
-        if isinstance(coord_raw, (list, tuple)) and len(coord_raw) >= 2:
-            lon, lat = coord_raw[0], coord_raw[1]
+    # 起動時に構築済みのレスポンス形式リストを一度だけエンコードする
+    cached = _STATIONS_BODY_CACHE.get(target_id)
+    if cached is None:
+        stations = data_cache.stations_transformed_by_line.get(target_id, [])
+        logger.info(f"Found {len(stations)} stations for {target_id} (from index)")
+        body = _dumps_json({"stations": stations})
+        cached = _STATIONS_BODY_CACHE[target_id] = (body, _make_etag(body))
 
-        station_id = raw.get("id")
-        rank_entry = data_cache.station_rank_cache.get(station_id) if station_id else None
-        rank = rank_entry.get("rank") if rank_entry else "B"
-        dwell_time = rank_entry.get("dwell_time") if rank_entry else data_cache.get_station_dwell_time(station_id)
-
-        return {
-            "id": station_id,
-            "line_id": raw.get("railway"),
-            "name_ja": title.get("ja", ""),
-            "name_en": title.get("en", ""),
-            "coord": {"lon": lon, "lat": lat},
-            "rank": rank,
-            "dwell_time": dwell_time,
-        }
-
-    return {"stations": [to_station(st) for st in stations]}
+    return _cached_json_response(request, cached, REVALIDATE_CACHE_CONTROL)
 
 
 @app.get("/api/stations/search")
@@ -254,17 +407,10 @@ async def search_stations(
 
 
 
-@app.put("/api/stations/{station_id}/rank")
-async def update_station_rank(
-    station_id: str,
-    update_data: StationRankUpdate,
-    db: Session = Depends(get_db),
-):
-    if update_data.dwell_time < 0:
-        raise HTTPException(status_code=400, detail="dwell_time must be >= 0")
-    if update_data.rank not in {"S", "A", "B"}:
-        raise HTTPException(status_code=400, detail="rank must be one of: S, A, B")
-
+def _save_station_rank(
+    db: Session, station_id: str, update_data: StationRankUpdate
+) -> Dict[str, Any]:
+    """StationRank を upsert して保存後の値を返す（同期 DB 処理）"""
     rank_obj = db.query(StationRank).filter(StationRank.station_id == station_id).first()
 
     if not rank_obj:
@@ -277,11 +423,27 @@ async def update_station_rank(
     db.commit()
     db.refresh(rank_obj)
 
-    data_cache.station_rank_cache[station_id] = {
+    return {
+        "station_id": rank_obj.station_id,
         "rank": rank_obj.rank,
         "dwell_time": rank_obj.dwell_time,
     }
 
+
+@app.put("/api/stations/{station_id}/rank")
+async def update_station_rank(
+    station_id: str,
+    update_data: StationRankUpdate,
+    db: Session = Depends(get_db),
+):
+    # SQLite への書き込みはブロッキングなのでスレッドで実行し、イベントループを塞がない
+    # （メモリ上のキャッシュ更新は他のハンドラと競合しないようループ側で行う）
+    saved = await asyncio.to_thread(_save_station_rank, db, station_id, update_data)
+
+    data_cache.apply_station_rank(station_id, saved["rank"], saved["dwell_time"])
+    # 駅は複数路線に属しうるので、エンコード済みの駅一覧はまとめて破棄する
+    _STATIONS_BODY_CACHE.clear()
+
     logger.info(
         "Station Rank Updated: %s -> %s (%ds)",
         station_id,
@@ -289,11 +451,7 @@ async def update_station_rank(
         update_data.dwell_time,
     )
 
-    return {"status": "success", "data": {
-        "station_id": rank_obj.station_id,
-        "rank": rank_obj.rank,
-        "dwell_time": rank_obj.dwell_time,
-    }}
+    return {"status": "success", "data": saved}
 
 
 # ============================================================
@@ -368,14 +526,10 @@ def resolve_subline_coords(
     end_point = coords[-1]
 
     def find_nearest_idx(point, coord_list):
-        min_dist = float('inf')
-        min_idx = 0
-        for i, c in enumerate(coord_list):
-            dist = (c[0] - point[0])**2 + (c[1] - point[1])**2
-            if dist < min_dist:
-                min_dist = dist
-                min_idx = i
-        return min_idx
+        # 距離計算と最小値探索を C 実装（math.dist / min / list.index）で回す
+        # （座標は [lon, lat] の2要素。同距離なら先頭側のインデックスを返す）
+        dists = list(map(math.dist, coord_list, repeat((point[0], point[1]))))
+        return dists.index(min(dists))
 
     start_idx = find_nearest_idx(start_point, ref_coords)
     end_idx = find_nearest_idx(end_point, ref_coords)
@@ -384,8 +538,9 @@ def resolve_subline_coords(
     if start_idx <= end_idx:
         return ref_coords[start_idx:end_idx + 1]
     else:
-        # 逆方向の場合は反転
-        return list(reversed(ref_coords[end_idx:start_idx + 1]))
+        # 逆方向の場合は負のステップで1回のスライスとして反転
+        stop = end_idx - 1 if end_idx > 0 else None
+        return ref_coords[start_idx:stop:-1]
 
 
 def merge_sublines_v2(
@@ -411,13 +566,19 @@ def merge_sublines_v2(
     if all_railways_cache is None:
         all_railways_cache = {}
 
+    # subline が1本だけなら接続グラフは不要（結果は下の一般処理と同じ）
+    if len(sublines) == 1:
+        coords = resolve_subline_coords(sublines[0], all_railways_cache)
+        return list(coords) if len(coords) >= 2 else []
+
     def coord_key(coord):
         """座標を丸めてハッシュ可能なキーに変換"""
         return (round(coord[0], 8), round(coord[1], 8))
 
     # 1. 各sublineの座標を解決（type=subなら参照先を使用）
-    start_coords: Dict[tuple, List[int]] = {}  # coord_key -> [subline_index, ...]
-    end_coords: Dict[tuple, List[int]] = {}    # coord_key -> [subline_index, ...]
+    # グラフ構築には始点側の索引だけあればよい（終点キーは valid_sublines と同じ順で保持）
+    start_coords: Dict[tuple, List[int]] = defaultdict(list)  # coord_key -> [subline_index, ...]
+    end_keys: List[tuple] = []
 
     valid_sublines: List[tuple] = []
     for i, sub in enumerate(sublines):
@@ -425,12 +586,8 @@ def merge_sublines_v2(
         coords = resolve_subline_coords(sub, all_railways_cache)
         if len(coords) >= 2:
             valid_sublines.append((i, coords))
-
-            start_key = coord_key(coords[0])
-            end_key = coord_key(coords[-1])
-
-            start_coords.setdefault(start_key, []).append(i)
-            end_coords.setdefault(end_key, []).append(i)
+            start_coords[coord_key(coords[0])].append(i)
+            end_keys.append(coord_key(coords[-1]))
 
     if not valid_sublines:
         return []
@@ -439,8 +596,7 @@ def merge_sublines_v2(
     graph: Dict[int, List[int]] = {i: [] for i, _ in valid_sublines}
     in_degree: Dict[int, int] = {i: 0 for i, _ in valid_sublines}
 
-    for i, coords in valid_sublines:
-        end_key = coord_key(coords[-1])
+    for (i, _), end_key in zip(valid_sublines, end_keys):
         if end_key in start_coords:
             for j in start_coords[end_key]:
                 if i != j:
@@ -461,18 +617,20 @@ def merge_sublines_v2(
         if start_idx is None:
             start_idx = valid_sublines[0][0]
 
-    # 4. DFSで順序を決定
+    # 4. DFSで順序を決定（再帰ではなく明示的なスタックで行きがけ順を求める）
     ordered_indices: List[int] = []
     visited: set = set()
 
-    def dfs(idx: int):
-        if idx in visited:
-            return
-        visited.add(idx)
-        ordered_indices.append(idx)
-        for next_idx in graph[idx]:
-            if next_idx not in visited:
-                dfs(next_idx)
+    def dfs(root: int):
+        stack = [root]
+        while stack:
+            idx = stack.pop()
+            if idx in visited:
+                continue
+            visited.add(idx)
+            ordered_indices.append(idx)
+            # 先頭の接続先から辿るよう逆順に積む（再帰版と同じ訪問順）
+            stack.extend(reversed(graph[idx]))
 
     dfs(start_idx)
 
@@ -519,50 +677,56 @@ def merge_sublines_fallback(sublines: List[Dict]) -> List[List[float]]:
     def coord_key(coord):
         return (round(coord[0], 8), round(coord[1], 8))
 
-    def dist_sq(c1, c2):
-        return (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2
-
     valid = [(i, sub.get("coords", [])) for i, sub in enumerate(sublines) if sub.get("coords")]
     if not valid:
         return []
 
-    used = [False] * len(valid)
     result: List[List[float]] = []
 
+    # 各sublineの端点 (始点x, 始点y, 終点x, 終点y) を一度だけ取り出しておく
+    endpoints = [(c[0][0], c[0][1], c[-1][0], c[-1][1]) for _, c in valid]
+    # 未使用のsubline（元の順序を保つので、同距離なら従来どおり先頭側が選ばれる）
+    remaining = list(range(1, len(valid)))
+
     # 最初のsublineから開始
-    used[0] = True
     coords = valid[0][1]
     result.extend(coords)
     current_end = coords[-1]
 
-    for _ in range(len(valid) - 1):
-        best_idx = -1
+    while remaining:
+        best_pos = -1
         best_dist = float('inf')
         best_reversed = False
+        # 二乗ユークリッド距離（端点をローカル変数に展開して関数呼び出しを省く）
+        end_x, end_y = current_end[0], current_end[1]
 
-        for i, (_, coords) in enumerate(valid):
-            if used[i] or not coords:
-                continue
+        for pos, i in enumerate(remaining):
+            sx, sy, ex, ey = endpoints[i]
 
-            d_start = dist_sq(coords[0], current_end)
+            dx = sx - end_x
+            dy = sy - end_y
+            d_start = dx * dx + dy * dy
             if d_start < best_dist:
                 best_dist = d_start
-                best_idx = i
+                best_pos = pos
                 best_reversed = False
 
-            d_end = dist_sq(coords[-1], current_end)
+            dx = ex - end_x
+            dy = ey - end_y
+            d_end = dx * dx + dy * dy
             if d_end < best_dist:
                 best_dist = d_end
-                best_idx = i
+                best_pos = pos
                 best_reversed = True
 
-        if best_idx < 0:
+        if best_pos < 0:
             break
 
-        used[best_idx] = True
+        # 使用済みは走査対象から外し、以降の反復を短くする
+        best_idx = remaining.pop(best_pos)
         coords = valid[best_idx][1]
         if best_reversed:
-            coords = list(reversed(coords))
+            coords = coords[::-1]
 
         if result and coord_key(coords[0]) == coord_key(result[-1]):
             result.extend(coords[1:])
@@ -574,54 +738,54 @@ def merge_sublines_fallback(sublines: List[Dict]) -> List[List[float]]:
     return result
 
 
-# ============================================================
-# API エンドポイント: 線路形状
-# ============================================================
+# 路線ID → マージ済み FeatureCollection のエンコード済み JSON と ETag
+# （coordinates.json は静的なので一度だけ構築・エンコードする）
+_SHAPE_BODY_CACHE: Dict[str, Tuple[bytes, str]] = {}
+# 参照解決用の全路線座標（build_all_railways_cache の結果）
+_ALL_RAILWAYS_CACHE: Optional[Dict[str, List[List[float]]]] = None
 
-@app.get("/api/shapes")
-async def get_shapes(
-    lineId: Optional[str] = None,
-    line_id: Optional[str] = None  # エイリアス対応
-):
-    # 1. パラメータの正規化
-    target_param = lineId or line_id
-    logger.info(f"GET /api/shapes called. Param: {target_param}")
 
-    if target_param is None:
-        raise HTTPException(status_code=400, detail="lineId (or line_id) query parameter is required")
+def _needs_reference_coords(sublines: List[Dict]) -> bool:
+    """resolve_subline_coords が参照先路線の座標を使う subline を含むか"""
+    return any(
+        sub.get("type", "main") != "main" and len(sub.get("coords", [])) <= 10
+        for sub in sublines
+    )
 
-    # 2. ID解決
-    target_id = resolve_line_id(target_param)
-    logger.info(f"Resolving Shape ID: '{target_param}' -> '{target_id}'")
 
-    # 3. Railwaysデータの確認
-    exists = any(l.get("id") == target_id for l in data_cache.railways)
-    if not exists:
-        logger.error(f"Shape lookup failed: ID '{target_id}' not found in railways.")
-        raise HTTPException(status_code=404, detail=f"Line not found in railways: {target_id}")
+def _build_shape(target_id: str) -> Optional[Tuple[bytes, str]]:
+    """
+    路線の sublines をマージして GeoJSON FeatureCollection を構築し、
+    JSON にエンコードして返す。
+    結果は _SHAPE_BODY_CACHE に保持し、2回目以降はそのまま返す。
 
-    # 2. Coordinatesデータの検索
-    railway_coords = data_cache.coordinates.get("railways", [])
-    entry = next((c for c in railway_coords if c.get("id") == target_id), None)
-    
+    Returns:
+        (FeatureCollection の JSON バイト列, ETag)。座標が見つからない・空の場合は None
+    """
+    cached = _SHAPE_BODY_CACHE.get(target_id)
+    if cached is not None:
+        return cached
+
+    entry = data_cache.coord_entries_by_id.get(target_id)
     if not entry:
-        logger.error(f"Target ID {target_id} not found in coordinates.json")
-        # デバッグ: 近いIDがないか探す
-        candidates = [c.get("id") for c in railway_coords if "Chuo" in c.get("id", "")]
-        logger.info(f"Did you mean one of these? {candidates}")
-        raise HTTPException(status_code=404, detail=f"Shape not found in coordinates: {lineId} -> {target_id}")
+        return None
 
-    # 3. 座標結合処理 (MS12: グラフベースのマージに改善 + 参照解決)
+    # MS12: グラフベースのマージに改善 + 参照解決
     sublines = entry.get("sublines", [])
     is_loop = entry.get("loop", False)
 
     logger.info(f"Found entry for {target_id}, has {len(sublines)} sublines, loop={is_loop}")
 
-    # 参照解決用のキャッシュを構築（全路線の座標）
-    all_railways_cache = build_all_railways_cache(data_cache.coordinates)
+    # 参照解決用のキャッシュ（全路線の座標）は、参照解決が必要な路線が来たときに一度だけ構築
+    global _ALL_RAILWAYS_CACHE
+    railways_cache: Dict[str, List[List[float]]] = {}
+    if _needs_reference_coords(sublines):
+        if _ALL_RAILWAYS_CACHE is None:
+            _ALL_RAILWAYS_CACHE = build_all_railways_cache(data_cache.coordinates)
+        railways_cache = _ALL_RAILWAYS_CACHE
 
     # グラフベースのマージを試行（参照解決を含む）
-    merged_coords = merge_sublines_v2(sublines, is_loop=is_loop, all_railways_cache=all_railways_cache)
+    merged_coords = merge_sublines_v2(sublines, is_loop=is_loop, all_railways_cache=railways_cache)
 
     # フォールバック: グラフベースが失敗した場合
     if not merged_coords:
@@ -630,7 +794,7 @@ async def get_shapes(
 
     if not merged_coords:
         logger.error(f"Merged coords empty for {target_id}")
-        raise HTTPException(status_code=404, detail=f"Shape coordinates are empty: {lineId}")
+        return None
 
     logger.info(f"Successfully merged {len(merged_coords)} points for {target_id}")
 
@@ -647,21 +811,90 @@ async def get_shapes(
         },
     }
 
-    return {
+    body = _dumps_json({
         "type": "FeatureCollection",
         "features": [feature],
-    }
+    })
+    cached = _SHAPE_BODY_CACHE[target_id] = (body, _make_etag(body))
+    return cached
+
+
+def _warm_shape_cache() -> None:
+    """対応路線（SUPPORTED_LINES）の線路形状を起動時にマージしておく"""
+    warmed = 0
+    for conf in SUPPORTED_LINES.values():
+        if _build_shape(conf.mt3d_id) is not None:
+            warmed += 1
+    logger.info("Shape cache warmed: %d lines", warmed)
+
+
+def _warm_track_polylines() -> None:
+    """
+    v4 の線路追従で使う線路形状（SoA + 累積距離）を起動時に構築しておく。
+    TripUpdate に依存しない唯一の計算なので、初回リクエストの取得待ちと
+    直列に実行されないよう先に済ませる。
+    """
+    if get_track_polyline is None:
+        return
+    warmed = 0
+    for conf in SUPPORTED_LINES.values():
+        if get_track_polyline(data_cache, conf.mt3d_id) is not None:
+            warmed += 1
+    logger.info("Track polylines warmed: %d lines", warmed)
+
+
+# ============================================================
+# API エンドポイント: 線路形状
+# ============================================================
+
+@app.get("/api/shapes")
+async def get_shapes(
+    request: Request,
+    lineId: Optional[str] = None,
+    line_id: Optional[str] = None  # エイリアス対応
+):
+    # 1. パラメータの正規化
+    target_param = lineId or line_id
+    logger.info(f"GET /api/shapes called. Param: {target_param}")
+
+    if target_param is None:
+        raise HTTPException(status_code=400, detail="lineId (or line_id) query parameter is required")
+
+    # 2. ID解決
+    target_id = resolve_line_id(target_param)
+    logger.info(f"Resolving Shape ID: '{target_param}' -> '{target_id}'")
+
+    # 3. Railwaysデータの確認
+    if target_id not in data_cache.railways_by_id:
+        logger.error(f"Shape lookup failed: ID '{target_id}' not found in railways.")
+        raise HTTPException(status_code=404, detail=f"Line not found in railways: {target_id}")
+
+    # 2. Coordinatesデータの検索
+    entry = data_cache.coord_entries_by_id.get(target_id)
+    
+    if not entry:
+        logger.error(f"Target ID {target_id} not found in coordinates.json")
+        # デバッグ: 近いIDがないか探す
+        candidates = [i for i in data_cache.coord_entries_by_id if "Chuo" in i]
+        logger.info(f"Did you mean one of these? {candidates}")
+        raise HTTPException(status_code=404, detail=f"Shape not found in coordinates: {lineId} -> {target_id}")
+
+    # 3. 座標結合処理（路線ごとにエンコード済みの FeatureCollection を返す）
+    cached = _build_shape(target_id)
+    if cached is None:
+        raise HTTPException(status_code=404, detail=f"Shape coordinates are empty: {lineId}")
+
+    return _cached_json_response(request, cached, STATIC_CACHE_CONTROL)
 
 # ▼▼▼ 追加: デバッグ用エンドポイント (ファイルの末尾などに追加) ▼▼▼
 @app.get("/api/debug/available_shapes")
 async def debug_available_shapes():
     """coordinates.json に含まれる全線路IDを返す"""
-    railway_coords = data_cache.coordinates.get("railways", [])
-    ids = [c.get("id") for c in railway_coords]
+    # 起動時に構築済みのソート済みIDをそのまま返す
     return {
-        "count": len(ids),
-        "ids": sorted(ids),
-        "chuo_related": [i for i in ids if "Chuo" in i]
+        "count": len(data_cache.shape_ids_sorted),
+        "ids": data_cache.shape_ids_sorted,
+        "chuo_related": data_cache.shape_ids_chuo,
     }
 
 @app.get("/api/trains/yamanote/positions")
@@ -686,27 +919,15 @@ async def get_yamanote_positions():
             ]
         }
     """
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    api_key = ODPT_API_KEY
     
     try:
-        from gtfs_rt_vehicle import fetch_yamanote_positions
-        positions = await fetch_yamanote_positions(api_key)
+        positions = await fetch_yamanote_positions(api_key, app.state.http_client)
         
         return {
-            "timestamp": positions[0].timestamp if positions else 0,
+            "timestamp": positions.timestamps[0] if positions else 0,
             "count": len(positions),
-            "trains": [
-                {
-                    "tripId": p.trip_id,
-                    "trainNumber": p.train_number,
-                    "direction": p.direction,
-                    "latitude": p.latitude,
-                    "longitude": p.longitude,
-                    "stopSequence": p.stop_sequence,
-                    "status": p.status
-                }
-                for p in positions
-            ]
+            "trains": positions.to_api_dicts(),
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -715,31 +936,15 @@ async def get_yamanote_positions_v2():
     """
     山手線のリアルタイム列車位置を取得（出発時刻付き）
     """
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    api_key = ODPT_API_KEY
     
     try:
-        from gtfs_rt_vehicle import fetch_yamanote_positions_with_schedule
-        positions = await fetch_yamanote_positions_with_schedule(api_key)
+        positions = await fetch_yamanote_positions_with_schedule(api_key, app.state.http_client)
         
         return {
             "timestamp": positions[0].timestamp if positions else 0,
             "count": len(positions),
-            "trains": [
-                {
-                    "tripId": p.trip_id,
-                    "trainNumber": p.train_number,
-                    "direction": p.direction,
-                    "latitude": p.latitude,
-                    "longitude": p.longitude,
-                    "stopSequence": p.stop_sequence,
-                    "status": p.status,
-                    # 新規追加
-                    "departureTime": p.departure_time,
-                    "nextArrivalTime": p.next_arrival_time,
-                    "timestamp": p.timestamp,  # GTFS-RT更新時刻
-                }
-                for p in positions
-            ]
+            "trains": [p.to_api_dict() for p in positions],
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -758,9 +963,7 @@ async def debug_trip_updates():
     MS1 TripUpdate デバッグ用エンドポイント。
     TripUpdate の取得結果をサンプルとして返す。
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    api_key = ODPT_API_KEY
     if not api_key:
         raise HTTPException(status_code=500, detail="ODPT_API_KEY not set")
     
@@ -801,14 +1004,11 @@ async def debug_trip_updates():
         
         # 統計情報
         total_count = len(schedules)
-        resolved_count = 0
+        # 解決済み駅数は fetch_trip_updates が列車ごとに集計済み
+        resolved_count = sum(s.resolved_count for s in schedules.values())
         direction_counts = {"InnerLoop": 0, "OuterLoop": 0, "Unknown": 0}
         
         for schedule in schedules.values():
-            for stu in schedule.schedules_by_seq.values():
-                if stu.resolved:
-                    resolved_count += 1
-            
             if schedule.direction in direction_counts:
                 direction_counts[schedule.direction] += 1
             else:
@@ -832,40 +1032,40 @@ async def debug_gtfs_route_ids():
     """
     デバッグ用: GTFS-RT フィードに含まれる全 route_id を一覧表示する。
     """
-    import httpx
-    from google.transit import gtfs_realtime_pb2
-    from constants import TRIP_UPDATE_URL
-    
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    api_key = ODPT_API_KEY
     if not api_key:
         raise HTTPException(status_code=500, detail="ODPT_API_KEY not set")
     
     try:
-        async with httpx.AsyncClient() as client:
-            url = f"{TRIP_UPDATE_URL}?acl:consumerKey={api_key}"
-            response = await client.get(url, timeout=10.0)
-            response.raise_for_status()
-            
-            feed = gtfs_realtime_pb2.FeedMessage()
-            feed.ParseFromString(response.content)
-            
-            # 全 route_id を収集
-            route_ids = {}
-            for entity in feed.entity:
-                if entity.HasField("trip_update"):
-                    route_id = entity.trip_update.trip.route_id or "(empty)"
-                    trip_id = entity.trip_update.trip.trip_id
-                    if route_id not in route_ids:
-                        route_ids[route_id] = {"count": 0, "sample_trip_ids": []}
-                    route_ids[route_id]["count"] += 1
-                    if len(route_ids[route_id]["sample_trip_ids"]) < 3:
-                        route_ids[route_id]["sample_trip_ids"].append(trip_id)
-            
-            return {
-                "total_entities": len(feed.entity),
-                "unique_route_ids": len(route_ids),
-                "route_ids": route_ids,
-            }
+        # v4 API と同じ single-flight 経由で取得（解析もスレッドで実行される）
+        feed = await fetch_trip_update_feed(app.state.http_client, api_key)
+        if feed is None:
+            raise HTTPException(status_code=502, detail="Failed to fetch TripUpdate feed")
+        
+        # 全 route_id を収集（件数とサンプルを平坦な2つの辞書で数え、最後にまとめる）
+        counts: Counter = Counter()
+        samples: Dict[str, List[str]] = defaultdict(list)
+        for entity in feed.entity:
+            if entity.HasField("trip_update"):
+                trip = entity.trip_update.trip
+                route_id = trip.route_id or "(empty)"
+                counts[route_id] += 1
+                sample = samples[route_id]
+                if len(sample) < 3:
+                    sample.append(trip.trip_id)
+        
+        route_ids = {
+            route_id: {"count": count, "sample_trip_ids": samples[route_id]}
+            for route_id, count in counts.items()
+        }
+        
+        return {
+            "total_entities": len(feed.entity),
+            "unique_route_ids": len(route_ids),
+            "route_ids": route_ids,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -875,13 +1075,11 @@ async def debug_gtfs_stop_ids(line_id: str):
     """
     デバッグ用: 特定路線のGTFS stop_id をサンプル表示
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    
     line_config = get_line_config(line_id)
     if not line_config:
         raise HTTPException(status_code=404, detail=f"Line '{line_id}' not found")
     
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    api_key = ODPT_API_KEY
     if not api_key:
         raise HTTPException(status_code=500, detail="ODPT_API_KEY not set")
     
@@ -924,96 +1122,145 @@ async def debug_gtfs_stop_ids(line_id: str):
 # MS3: TripUpdate-only v4 API
 # ============================================================================
 
-def _get_station_coord(station_id: str | None) -> tuple[float, float] | None:
+@dataclass(slots=True)
+class V4Location:
+    """v4 API の列車座標（地図描画で使うためネストを維持）"""
+    latitude: Optional[float]
+    longitude: Optional[float]
+    bearing: float
+
+
+@dataclass(slots=True)
+class V4TrainRow:
+    """v4 API の1列車分のレスポンス行（orjson が dataclass を直接エンコードする）"""
+    trip_id: str
+    train_number: Optional[str]
+    direction: Optional[str]
+    status: str
+    progress: Optional[float]
+    delay: int  # MS6: 遅延秒数
+    location: V4Location
+    prev_seq: Optional[int]
+    next_seq: Optional[int]
+    prev_station_id: Optional[str]
+    next_station_id: Optional[str]
+    now_ts: int
+    t0_departure: Optional[int]
+    t1_arrival: Optional[int]
+    feed_timestamp: Optional[int]
+
+
+def _v4_position_row(r, coord: Optional[tuple]) -> V4TrainRow:
     """
-    駅IDから座標を取得する。
-    data_cache.station_positions は (lon, lat) 形式。
-    返却は (lat, lon) 形式に変換。
+    SegmentProgress と座標から v4 API の1列車分のレスポンス行を作る。
+
+    地図描画で使う location 以外はネストせず1階層に展開する
+    （列車ごとの dict 生成数とエンコード量を減らすため）。
     """
-    if not station_id:
-        return None
-    
-    coord = data_cache.station_positions.get(station_id)
+    # 表示用の丸めはフロント側で行う（列車ごとの round() 呼び出しを省く）
     if coord:
-        lon, lat = coord
-        return (lat, lon)
-    return None
+        lat = coord[0]
+        lon = coord[1]
+        bearing = coord[2] if len(coord) > 2 else 0.0
+    else:
+        lat = lon = None
+        bearing = 0.0
+
+    return V4TrainRow(
+        trip_id=r.trip_id,
+        train_number=r.train_number,
+        direction=r.direction,
+        status=r.status,
+        progress=r.progress,
+        delay=r.delay,
+        location=V4Location(latitude=lat, longitude=lon, bearing=bearing),
+        prev_seq=r.prev_seq,
+        next_seq=r.next_seq,
+        prev_station_id=r.prev_station_id,
+        next_station_id=r.next_station_id,
+        now_ts=r.now_ts,
+        t0_departure=r.t0_departure,
+        t1_arrival=r.t1_arrival,
+        feed_timestamp=r.feed_timestamp,
+    )
+
 
+_TRAIN_NUMBER_KEY = attrgetter("train_number")
 
-def _calculate_position(
-    status: str,
-    progress: float | None,
-    prev_station_id: str | None,
-    next_station_id: str | None,
-) -> tuple[float | None, float | None]:
+
+def _sort_v4_positions(positions: List[V4TrainRow]) -> List[V4TrainRow]:
     """
-    列車の現在座標を計算する。
-    
+    v4 の列車行を direction -> train_number の順に並べる。
+
+    direction ごとのバケットに分けてから train_number だけで sort する
+    （タプルキーの lambda を呼ばずに済む）。train_number が None の行は
+    各バケットの先頭に元の順序のまま置く。
+    """
+    buckets: Dict[str, tuple[list, list]] = {}
+    for p in positions:
+        direction = p.direction or ""
+        bucket = buckets.get(direction)
+        if bucket is None:
+            bucket = buckets[direction] = ([], [])
+        bucket[p.train_number is not None].append(p)
+
+    ordered: List[V4TrainRow] = []
+    for direction in sorted(buckets):
+        unnumbered, numbered = buckets[direction]
+        numbered.sort(key=_TRAIN_NUMBER_KEY)
+        ordered.extend(unnumbered)
+        ordered.extend(numbered)
+    return ordered
+
+
+def _yamanote_position_rows(
+    schedules: Dict[str, Any], now_epoch: int
+) -> tuple[List[V4TrainRow], Optional[int]]:
+    """
+    山手線 v4 の進捗計算 → 座標計算 → 行の整形を行う（同期処理）。
+
+    Args:
+        now_epoch: リクエスト開始時に取得した現在時刻（unix seconds）
+
     Returns:
-        (latitude, longitude) のタプル。計算不能なら (None, None)。
+        (direction -> train_number 順に並べた行のリスト, 最初の列車の now_ts)
     """
-    # 1) stopped: 停車駅の座標
-    if status == "stopped":
-        # stopped時は prev_station_id == next_station_id
-        coord = _get_station_coord(prev_station_id)
-        if coord:
-            return coord
-        # フォールバック
-        coord = _get_station_coord(next_station_id)
-        if coord:
-            return coord
-        return (None, None)
+    # 2. MS2: 進捗計算
+    # invalid は表示しないので計算側で除外しておく
+    results = compute_all_progress(
+        schedules, now_ts=now_epoch, data_cache=data_cache, drop_invalid=True
+    )
     
-    # 2) running: 駅間の線形補間
-    if status == "running":
-        if progress is None:
-            return (None, None)
-        
-        prev_coord = _get_station_coord(prev_station_id)
-        next_coord = _get_station_coord(next_station_id)
-        
-        if prev_coord is None or next_coord is None:
-            # どちらかの座標が取れない
-            if prev_coord:
-                return prev_coord
-            if next_coord:
-                return next_coord
-            return (None, None)
-        
-        # 線形補間
-        lat0, lon0 = prev_coord
-        lat1, lon1 = next_coord
+    # 3. レスポンス構築
+    positions = []
+    now_ts = None
+    
+    for r in results:
+        # MS5: 座標計算（線路形状追従）
+        coord = calculate_coordinates(r, data_cache, "JR-East.Yamanote")
         
-        lat = lat0 + (lat1 - lat0) * progress
-        lon = lon0 + (lon1 - lon0) * progress
+        # now_ts を最初の列車から取得
+        if now_ts is None:
+            now_ts = r.now_ts
         
-        return (lat, lon)
+        positions.append(_v4_position_row(r, coord))
     
-    # 3) unknown / invalid: 基本 null
-    return (None, None)
+    # ソート: direction -> train_number
+    positions = _sort_v4_positions(positions)
+
+    return positions, now_ts
 
 
 @app.get("/api/trains/yamanote/positions/v4")
-async def get_yamanote_positions_v4():
+async def get_yamanote_positions_v4(api_key: str = Depends(require_api_key)):
     """
     MS3/MS5: TripUpdate-only v4 API エンドポイント。
     
     TripUpdate から列車位置を計算し、線路形状に沿った座標付きで返す。
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    from train_position_v4 import compute_all_progress, calculate_coordinates
-    
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
-    if not api_key:
-        return {
-            "source": "tripupdate_v4",
-            "status": "error",
-            "error": "ODPT_API_KEY not set",
-            "timestamp": int(datetime.now(JST).timestamp()),
-            "total_trains": 0,
-            "positions": [],
-        }
-    
+    # 現在時刻はリクエストごとに1回だけ取得し、全ての分岐で使い回す
+    now_epoch = int(time.time())
+
     try:
         # 1. MS1: TripUpdate取得
         client = app.state.http_client
@@ -1023,73 +1270,22 @@ async def get_yamanote_positions_v4():
             return {
                 "source": "tripupdate_v4",
                 "status": "no_data",
-                "timestamp": int(datetime.now(JST).timestamp()),
+                "timestamp": now_epoch,
                 "total_trains": 0,
                 "positions": [],
             }
         
-        # 2. MS2: 進捗計算
-        results = compute_all_progress(schedules, data_cache=data_cache)
+        # 2-3. 進捗計算・座標計算（CPU処理なのでイベントループを塞がないようスレッドで実行）
+        positions, now_ts = await asyncio.to_thread(_yamanote_position_rows, schedules, now_epoch)
         
-        # 3. レスポンス構築
-        positions = []
-        now_ts = None
-        
-        for r in results:
-            # invalid は除外（デバッグには残したい場合は別途）
-            if r.status == "invalid":
-                continue
-            
-            # MS5: 座標計算（線路形状追従）
-            coord = calculate_coordinates(r, data_cache, "JR-East.Yamanote")
-            lat = coord[0] if coord else None
-            lon = coord[1] if coord else None
-            
-            # now_ts を最初の列車から取得
-            if now_ts is None:
-                now_ts = r.now_ts
-            
-            positions.append({
-                "trip_id": r.trip_id,
-                "train_number": r.train_number,
-                "direction": r.direction,
-                "status": r.status,
-                "progress": round(r.progress, 4) if r.progress is not None else None,
-                "delay": r.delay,  # MS6: 遅延秒数
-                
-                "location": {
-                    "latitude": round(lat, 6) if lat is not None else None,
-                    "longitude": round(lon, 6) if lon is not None else None,
-                },
-                
-                "segment": {
-                    "prev_seq": r.prev_seq,
-                    "next_seq": r.next_seq,
-                    "prev_station_id": r.prev_station_id,
-                    "next_station_id": r.next_station_id,
-                },
-                
-                "times": {
-                    "now_ts": r.now_ts,
-                    "t0_departure": r.t0_departure,
-                    "t1_arrival": r.t1_arrival,
-                },
-                
-                "debug": {
-                    "feed_timestamp": r.feed_timestamp,
-                },
-            })
-        
-        # ソート: direction -> train_number
-        positions.sort(key=lambda p: (p["direction"] or "", p["train_number"] or ""))
-        
-        return {
+        # jsonable_encoder を経由せず、そのまま orjson でエンコードする
+        return FastJSONResponse({
             "source": "tripupdate_v4",
             "status": "success",
-            "timestamp": now_ts or int(datetime.now(JST).timestamp()),
+            "timestamp": now_ts or now_epoch,
             "total_trains": len(positions),
             "positions": positions,
-        }
+        })
     
     except Exception as e:
         logger.error(f"Error in v4 endpoint: {e}")
@@ -1097,7 +1293,7 @@ async def get_yamanote_positions_v4():
             "source": "tripupdate_v4",
             "status": "error",
             "error": str(e),
-            "timestamp": int(datetime.now(JST).timestamp()),
+            "timestamp": now_epoch,
             "total_trains": 0,
             "positions": [],
         }
@@ -1107,8 +1303,18 @@ async def get_yamanote_positions_v4():
 # MS10: Multi-Line Generic v4 API
 # ============================================================================
 
+# 路線ごとの v4 レスポンス本文（bytes）を共有する TTL（フロントのポーリング間隔 2 秒より短くし、
+# 同時刻に集中したリクエストだけをまとめる）
+V4_CACHE_TTL_SEC = 1.0
+_v4_positions_flight = SingleFlight(ttl=V4_CACHE_TTL_SEC)
+
+
 @app.get("/api/trains/{line_id}/positions/v4")
-async def get_train_positions_v4(line_id: str):
+async def get_train_positions_v4(
+    line_id: str,
+    debug: bool = Query(False, description="direction/status の集計を debug キーに含める"),
+    api_key: str = Depends(require_api_key),
+):
     """
     MS10: 汎用路線の列車位置 v4 API。
     
@@ -1116,38 +1322,117 @@ async def get_train_positions_v4(line_id: str):
     
     Args:
         line_id: 路線識別子 ("yamanote", "chuo_rapid", "keihin_tohoku", "sobu_local")
+        debug: True のときだけデバッグ用の集計をレスポンスに含める
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    from train_position_v4 import compute_all_progress, calculate_coordinates
-    
     # 1. 路線設定のロード
     line_config = get_line_config(line_id)
     if not line_config:
-        # 利用可能な路線一覧を取得
-        from config import SUPPORTED_LINES
-        available = ", ".join(sorted(SUPPORTED_LINES.keys())[:10]) + "..."
         raise HTTPException(
             status_code=404,
             detail=f"Line '{line_id}' is not supported. "
-                   f"Available lines: {available} (51 lines total)"
+                   f"Available lines: {_SUPPORTED_LINES_SORTED_HEAD} (51 lines total)"
         )
     
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
-    if not api_key:
+    async def build_body() -> bytes:
+        payload = await _compute_train_positions_v4(
+            line_id, line_config, api_key, app.state.http_client, debug=debug
+        )
+        return _dumps_json(payload)
+
+    # 同じ路線への同時ポーリングは1回の計算にまとめ、エンコード済みの本文を
+    # 短時間だけ再利用する（キャッシュヒット時はエンコードも不要）
+    body = await _v4_positions_flight.run((line_id, debug), build_body)
+    return Response(content=body, media_type="application/json")
+
+
+def _build_line_positions_v4(
+    line_id: str,
+    line_config: LineConfig,
+    schedules: Dict[str, Any],
+    now_epoch: Optional[int] = None,
+    debug: bool = False,
+) -> Dict[str, Any]:
+    """
+    1路線分の TrainSchedule から v4 API のレスポンス本体を構築する
+    （進捗計算 → 座標計算 → 行の整形）。
+
+    Args:
+        now_epoch: 現在時刻（unix seconds）。None なら time.time() を使用。
+            複数路線をまとめて計算するときは同じ値を渡して時刻を揃える。
+        debug: True のときだけ direction/status の集計を "debug" キーに含める。
+    """
+    if now_epoch is None:
+        now_epoch = int(time.time())
+
+    if not schedules:
         return {
             "source": "tripupdate_v4",
             "line_id": line_id,
             "line_name": line_config.name,
-            "status": "error",
-            "error": "ODPT_API_KEY not set",
-            "timestamp": int(datetime.now(JST).timestamp()),
+            "status": "no_data",
+            "timestamp": now_epoch,
             "total_trains": 0,
             "positions": [],
         }
     
+    # 3. MS2: 進捗計算
+    # invalid は表示しないので計算側で除外する（debug 集計のときだけ残す）
+    results = compute_all_progress(
+        schedules, now_ts=now_epoch, data_cache=data_cache, drop_invalid=not debug
+    )
+    valid_results = [r for r in results if r.status != "invalid"] if debug else results
+    
+    # 4. レスポンス構築
+    positions = []
+    now_ts = None
+
+    for r in valid_results:
+        # MS5: 座標計算（線路形状追従）
+        coord = calculate_coordinates(r, data_cache, line_config.mt3d_id)
+
+        if now_ts is None:
+            now_ts = r.now_ts
+
+        positions.append(_v4_position_row(r, coord))
+    
+    # ソート: direction -> train_number
+    positions = _sort_v4_positions(positions)
+    
+    payload = {
+        "source": "tripupdate_v4",
+        "line_id": line_id,
+        "line_name": line_config.name,
+        "status": "success",
+        "timestamp": now_ts or now_epoch,
+        "total_trains": len(positions),
+        "positions": positions,
+    }
+
+    # デバッグ情報（?debug=true のときだけ集計する。invalid も含む）
+    if debug:
+        payload["debug"] = {
+            "direction_stats": dict(Counter(r.direction or "None" for r in results)),
+            "status_stats": dict(Counter(r.status for r in results)),
+            "schedules_count": len(schedules),
+        }
+
+    return payload
+
+
+async def _compute_train_positions_v4(
+    line_id: str,
+    line_config: LineConfig,
+    api_key: str,
+    client: httpx.AsyncClient,
+    debug: bool = False,
+) -> Dict[str, Any]:
+    """
+    get_train_positions_v4 の本体（TripUpdate 取得 → 進捗計算 → レスポンス構築）。
+    _v4_positions_flight 経由で呼ばれ、エンコード済みの結果が V4_CACHE_TTL_SEC 秒だけ共有される。
+    """
+    now_epoch = int(time.time())
     try:
         # 2. MS10: target_route_id を指定して TripUpdate 取得
-        client = app.state.http_client
         schedules = await fetch_trip_updates(
             client,
             api_key,
@@ -1156,96 +1441,10 @@ async def get_train_positions_v4(line_id: str):
             mt3d_prefix=line_config.mt3d_id  # MS11: 駅IDプレフィックス
         )
         
-        if not schedules:
-            return {
-                "source": "tripupdate_v4",
-                "line_id": line_id,
-                "line_name": line_config.name,
-                "status": "no_data",
-                "timestamp": int(datetime.now(JST).timestamp()),
-                "total_trains": 0,
-                "positions": [],
-            }
-        
-        # 3. MS2: 進捗計算
-        results = compute_all_progress(schedules, data_cache=data_cache)
-        
-        # 4. レスポンス構築
-        positions = []
-        now_ts = None
-
-        # デバッグ: direction 分布の統計
-        direction_stats = {}
-        status_stats = {}
-
-        for r in results:
-            # 統計収集（invalidも含む）
-            d = r.direction or "None"
-            direction_stats[d] = direction_stats.get(d, 0) + 1
-            status_stats[r.status] = status_stats.get(r.status, 0) + 1
-
-            if r.status == "invalid":
-                continue
-
-            # MS5: 座標計算（線路形状追従）
-            coord = calculate_coordinates(r, data_cache, line_config.mt3d_id)
-            lat = coord[0] if coord else None
-            lon = coord[1] if coord else None
-            bearing = coord[2] if coord and len(coord) > 2 else 0.0
-
-            if now_ts is None:
-                now_ts = r.now_ts
-
-            positions.append({
-                "trip_id": r.trip_id,
-                "train_number": r.train_number,
-                "direction": r.direction,
-                "status": r.status,
-                "progress": round(r.progress, 4) if r.progress is not None else None,
-                "delay": r.delay,
-                
-                "location": {
-                    "latitude": round(lat, 6) if lat is not None else None,
-                    "longitude": round(lon, 6) if lon is not None else None,
-                    "bearing": round(bearing, 2) if bearing is not None else 0.0,
-                },
-                
-                "segment": {
-                    "prev_seq": r.prev_seq,
-                    "next_seq": r.next_seq,
-                    "prev_station_id": r.prev_station_id,
-                    "next_station_id": r.next_station_id,
-                },
-                
-                "times": {
-                    "now_ts": r.now_ts,
-                    "t0_departure": r.t0_departure,
-                    "t1_arrival": r.t1_arrival,
-                },
-                
-                "debug": {
-                    "feed_timestamp": r.feed_timestamp,
-                },
-            })
-        
-        # ソート: direction -> train_number
-        positions.sort(key=lambda p: (p["direction"] or "", p["train_number"] or ""))
-        
-        return {
-            "source": "tripupdate_v4",
-            "line_id": line_id,
-            "line_name": line_config.name,
-            "status": "success",
-            "timestamp": now_ts or int(datetime.now(JST).timestamp()),
-            "total_trains": len(positions),
-            "positions": positions,
-            # デバッグ情報
-            "debug": {
-                "direction_stats": direction_stats,
-                "status_stats": status_stats,
-                "schedules_count": len(schedules),
-            },
-        }
+        # 進捗計算・座標計算は CPU 処理なのでイベントループを塞がないようスレッドで実行
+        return await asyncio.to_thread(
+            _build_line_positions_v4, line_id, line_config, schedules, now_epoch, debug
+        )
     
     except Exception as e:
         logger.error(f"Error in generic v4 endpoint for {line_id}: {e}")
@@ -1255,16 +1454,98 @@ async def get_train_positions_v4(line_id: str):
             "line_name": line_config.name,
             "status": "error",
             "error": str(e),
-            "timestamp": int(datetime.now(JST).timestamp()),
+            "timestamp": now_epoch,
             "total_trains": 0,
             "positions": [],
         }
 
 
+@app.get("/api/trains/positions/v4")
+async def get_train_positions_v4_batch(
+    lines: str = Query(..., description="カンマ区切りの路線ID (例: yamanote,chuo_rapid)"),
+    api_key: str = Depends(require_api_key),
+):
+    """
+    複数路線の列車位置をまとめて返す v4 API。
+
+    TripUpdate フィードは全路線共通のため1回だけ取得・解析し、
+    路線ごとに抽出して /api/trains/{line_id}/positions/v4 と同じ形式で返す。
+    """
+    line_ids = list(dict.fromkeys(x.strip() for x in lines.split(",") if x.strip()))
+    # 路線設定は最初に一度だけ解決し、以降のループでは引き直さない
+    configs = {x: get_line_config(x) for x in line_ids}
+    unknown = [x for x, conf in configs.items() if conf is None]
+    if not line_ids or unknown:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Unsupported line(s): {', '.join(unknown) or lines}",
+        )
+
+    # 全路線で同じ現在時刻を使う（レスポンスの timestamp もこれに揃える）
+    now_epoch = int(time.time())
+
+    feed = await fetch_trip_update_feed(app.state.http_client, api_key)
+
+    def build_all() -> Dict[str, Dict[str, Any]]:
+        results: Dict[str, Dict[str, Any]] = {}
+        for line_id, line_config in configs.items():
+            try:
+                schedules = {}
+                if feed is not None:
+                    schedules = build_train_schedules(
+                        feed,
+                        data_cache,
+                        target_route_id=line_config.gtfs_route_id,
+                        mt3d_prefix=line_config.mt3d_id,
+                    )
+                results[line_id] = _build_line_positions_v4(
+                    line_id, line_config, schedules, now_epoch
+                )
+            except Exception as e:
+                logger.error(f"Error in batched v4 endpoint for {line_id}: {e}")
+                results[line_id] = {
+                    "source": "tripupdate_v4",
+                    "line_id": line_id,
+                    "line_name": line_config.name,
+                    "status": "error",
+                    "error": str(e),
+                    "timestamp": now_epoch,
+                    "total_trains": 0,
+                    "positions": [],
+                }
+        return results
+
+    # 路線ごとの抽出・進捗計算は CPU 処理なのでイベントループを塞がないようスレッドで実行
+    results = await asyncio.to_thread(build_all)
+
+    # jsonable_encoder を経由せず、そのまま orjson でエンコードする
+    return FastJSONResponse({
+        "source": "tripupdate_v4",
+        "status": "success" if feed is not None else "no_data",
+        "timestamp": now_epoch,
+        "lines": results,
+    })
+
+
 # ============================================================================
 # Route Search API (OTP + Train Position Integration)
 # ============================================================================
 
+# OTP の route_id → 路線ID（OTPのGTFSデータでは数字IDが使われる場合がある）
+_ROUTE_TO_LINE: Dict[str, str] = {
+    # 数字ID形式 (JR東日本GTFSデータ)
+    "10": "yamanote",           # 山手線
+    "11": "chuo_rapid",         # 中央線快速
+    "12": "sobu_local",         # 中央・総武緩行線
+    "22": "keihin_tohoku",      # 京浜東北・根岸線
+    # フルID形式 (バックアップ)
+    "JR-East.Yamanote": "yamanote",
+    "JR-East.ChuoRapid": "chuo_rapid",
+    "JR-East.KeihinTohokuNegishi": "keihin_tohoku",
+    "JR-East.ChuoSobuLocal": "sobu_local",
+}
+
+
 def _identify_line_from_route_id(route_gtfs_id: str) -> Optional[str]:
     """
     OTPの route.gtfsId から路線IDを特定する。
@@ -1276,27 +1557,8 @@ def _identify_line_from_route_id(route_gtfs_id: str) -> Optional[str]:
         路線ID (例: "yamanote") または None
     """
     # "FeedId:RouteId" 形式から RouteId を抽出
-    if ":" in route_gtfs_id:
-        route_id = route_gtfs_id.split(":", 1)[1]
-    else:
-        route_id = route_gtfs_id
-
-    # 既知の路線IDとのマッピング
-    # OTPのGTFSデータでは数字IDが使われる場合がある
-    route_to_line = {
-        # 数字ID形式 (JR東日本GTFSデータ)
-        "10": "yamanote",           # 山手線
-        "11": "chuo_rapid",         # 中央線快速
-        "12": "sobu_local",         # 中央・総武緩行線
-        "22": "keihin_tohoku",      # 京浜東北・根岸線
-        # フルID形式 (バックアップ)
-        "JR-East.Yamanote": "yamanote",
-        "JR-East.ChuoRapid": "chuo_rapid",
-        "JR-East.KeihinTohokuNegishi": "keihin_tohoku",
-        "JR-East.ChuoSobuLocal": "sobu_local",
-    }
-
-    return route_to_line.get(route_id)
+    _, sep, route_id = route_gtfs_id.partition(":")
+    return _ROUTE_TO_LINE.get(route_id if sep else route_gtfs_id)
 
 
 def _extract_trip_id_suffix(trip_gtfs_id: str) -> str:
@@ -1325,16 +1587,10 @@ async def _get_train_positions_for_lines(
     Returns:
         { "trip_id_suffix": position_dict, ... }
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    from train_position_v4 import compute_all_progress, calculate_coordinates
-
-    all_positions: Dict[str, Dict] = {}
-
-    for line_id in set(line_ids):  # 重複を除去
-        line_config = get_line_config(line_id)
-        if not line_config:
-            continue
+    # 全路線で同じ現在時刻を使う
+    now_epoch = int(time.time())
 
+    async def fetch_one(line_id: str, line_config: LineConfig) -> Dict[str, Dict]:
         try:
             schedules = await fetch_trip_updates(
                 client,
@@ -1345,36 +1601,64 @@ async def _get_train_positions_for_lines(
             )
 
             if not schedules:
-                continue
+                return {}
 
-            results = compute_all_progress(schedules, data_cache=data_cache)
-
-            for r in results:
-                if r.status == "invalid":
-                    continue
-
-                coord = calculate_coordinates(r, data_cache, line_config.mt3d_id)
-                lat = coord[0] if coord else None
-                lon = coord[1] if coord else None
-
-                all_positions[r.trip_id] = {
-                    "status": r.status,
-                    "latitude": round(lat, 6) if lat is not None else None,
-                    "longitude": round(lon, 6) if lon is not None else None,
-                    "delay": r.delay,
-                    "progress": round(r.progress, 4) if r.progress is not None else None,
-                    "segment": {
-                        "prev_station_id": r.prev_station_id,
-                        "next_station_id": r.next_station_id,
-                    }
-                }
+            # 進捗計算・座標計算は CPU 処理なのでイベントループを塞がないようスレッドで実行
+            return await asyncio.to_thread(
+                _route_leg_positions, line_config, schedules, now_epoch
+            )
         except Exception as e:
             logger.error(f"Failed to get positions for {line_id}: {e}")
-            continue
+            return {}
 
+    # 路線設定は重複を除いて一度だけ解決し、未対応の路線はここで落とす
+    configs = {}
+    for line_id in set(line_ids):
+        line_config = get_line_config(line_id)
+        if line_config:
+            configs[line_id] = line_config
+
+    # 路線ごとの取得を並行に実行（フィード取得自体は single-flight で1回にまとまる）
+    per_line = await asyncio.gather(
+        *(fetch_one(line_id, line_config) for line_id, line_config in configs.items())
+    )
+
+    all_positions: Dict[str, Dict] = {}
+    for positions in per_line:
+        all_positions.update(positions)
     return all_positions
 
 
+def _route_leg_positions(
+    line_config: LineConfig,
+    schedules: Dict[str, Any],
+    now_epoch: int,
+) -> Dict[str, Dict]:
+    """1路線分の TrainSchedule から経路検索の leg に付加する列車位置を作る（同期処理）"""
+    positions: Dict[str, Dict] = {}
+    results = compute_all_progress(
+        schedules, now_ts=now_epoch, data_cache=data_cache, drop_invalid=True
+    )
+
+    for r in results:
+        coord = calculate_coordinates(r, data_cache, line_config.mt3d_id)
+
+        # v4 と同様、表示用の丸めはフロント側に任せて値をそのまま返す
+        positions[r.trip_id] = {
+            "status": r.status,
+            "latitude": coord[0] if coord else None,
+            "longitude": coord[1] if coord else None,
+            "delay": r.delay,
+            "progress": r.progress,
+            "segment": {
+                "prev_station_id": r.prev_station_id,
+                "next_station_id": r.next_station_id,
+            }
+        }
+
+    return positions
+
+
 @app.get("/api/route/search")
 async def route_search(
     # 座標指定（駅名指定と排他）
@@ -1386,8 +1670,8 @@ async def route_search(
     from_station: Optional[str] = Query(None, description="出発駅名（日本語または英語）"),
     to_station: Optional[str] = Query(None, description="到着駅名（日本語または英語）"),
     # 共通パラメータ
-    date: str = Query(..., description="日付 (YYYY-MM-DD)", regex=r"^\d{4}-\d{2}-\d{2}$"),
-    time: str = Query(..., description="時刻 (HH:MM)", regex=r"^\d{2}:\d{2}$"),
+    date: str = Query(..., description="日付 (YYYY-MM-DD)", pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    time: str = Query(..., description="時刻 (HH:MM)", pattern=r"^\d{2}:\d{2}$"),
     arrive_by: bool = Query(False, description="True: 到着時刻指定, False: 出発時刻指定"),
 ):
     """
@@ -1437,7 +1721,7 @@ async def route_search(
             detail="目的地が指定されていません。to_lat/to_lon または to_station を指定してください"
         )
 
-    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    api_key = ODPT_API_KEY
 
     try:
         client = app.state.http_client
@@ -1481,18 +1765,19 @@ async def route_search(
                 "itineraries": []
             }
 
-        # 3. 使用される路線を特定
-        transit_modes = {"RAIL", "BUS", "SUBWAY", "TRAM", "FERRY", "CABLE_CAR", "GONDOLA", "FUNICULAR", "TRANSIT"}
+        # 3. 使用される路線を特定し、位置を付加する leg と trip_id を同じ走査で控えておく
         line_ids_needed = set()
+        pending_legs = []
         for itin in itineraries:
             for leg in itin.get("legs", []):
-                if leg.get("mode") in transit_modes:
+                if leg.get("mode") in TRANSIT_MODES:
                     route_info = leg.get("route", {})
                     if route_info:
                         route_gtfs_id = route_info.get("gtfs_id", "")
                         line_id = _identify_line_from_route_id(route_gtfs_id)
                         if line_id:
                             line_ids_needed.add(line_id)
+                    pending_legs.append((leg, _extract_trip_id_suffix(leg.get("trip_id", ""))))
 
         # 4. 必要な路線の列車位置を取得
         train_positions = {}
@@ -1503,18 +1788,9 @@ async def route_search(
                 api_key
             )
 
-        # 5. 各 leg に現在位置情報を付加
-        for itin in itineraries:
-            for leg in itin.get("legs", []):
-                if leg.get("mode") in transit_modes:
-                    trip_gtfs_id = leg.get("trip_id", "")
-                    trip_id_suffix = _extract_trip_id_suffix(trip_gtfs_id)
-
-                    position = train_positions.get(trip_id_suffix)
-                    if position:
-                        leg["current_position"] = position
-                    else:
-                        leg["current_position"] = None
+        # 5. 各 leg に現在位置情報を付加（3. で控えた leg だけを見る）
+        for leg, trip_id_suffix in pending_legs:
+            leg["current_position"] = train_positions.get(trip_id_suffix) or None
 
         # クエリ情報を構築
         query_info = {
@@ -1530,11 +1806,12 @@ async def route_search(
         if resolved_to_station:
             query_info["to"]["station"] = resolved_to_station
 
-        return {
+        # 経路と列車位置を含む大きな dict なので、jsonable_encoder を経由せず直接エンコードする
+        return FastJSONResponse({
             "status": "success",
             "query": query_info,
             "itineraries": itineraries
-        }
+        })
 
     except Exception as e:
         logger.error(f"Route search error: {e}")
@@ -10,10 +10,15 @@ from __future__ import annotations
 import httpx
 import logging
 from typing import Dict, List, Optional, Any
-from datetime import datetime
+from time import localtime
 
 logger = logging.getLogger(__name__)
 
+# 公共交通機関として扱う leg の mode（OTPは RAIL, BUS, SUBWAY, TRAM 等の具体的なモードを返す）
+TRANSIT_MODES = frozenset({
+    "RAIL", "BUS", "SUBWAY", "TRAM", "FERRY", "CABLE_CAR", "GONDOLA", "FUNICULAR", "TRANSIT",
+})
+
 # OTP GraphQL エンドポイント
 OTP_GRAPHQL_ENDPOINT = "http://localhost:8080/otp/routers/default/index/graphql"
 
@@ -177,12 +182,23 @@ def parse_otp_response(otp_response: Dict[str, Any]) -> List[Dict[str, Any]]:
 
 
 def _ms_to_iso(ms: Optional[int]) -> Optional[str]:
-    """Unix ミリ秒を ISO 8601 形式に変換"""
+    """
+    Unix ミリ秒を ISO 8601 形式（ローカル時刻）に変換
+
+    leg ごとに呼ばれるため datetime を作らず直接整形する。
+    出力は datetime.fromtimestamp(ms / 1000).isoformat() と同じ。
+    """
     if ms is None:
         return None
     try:
-        dt = datetime.fromtimestamp(ms / 1000)
-        return dt.isoformat()
+        sec, ms_rem = divmod(int(ms), 1000)
+        tm = localtime(sec)
+        iso = (
+            f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+            f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
+        )
+        # isoformat() と同様、端数があるときだけマイクロ秒まで付ける
+        return f"{iso}.{ms_rem:03d}000" if ms_rem else iso
     except Exception:
         return None
 
@@ -219,9 +235,7 @@ def _parse_leg(leg: Dict[str, Any]) -> Dict[str, Any]:
     }
 
     # 公共交通機関モードの場合、路線・列車情報を追加
-    # OTPは RAIL, BUS, SUBWAY, TRAM 等の具体的なモードを返す
-    transit_modes = {"RAIL", "BUS", "SUBWAY", "TRAM", "FERRY", "CABLE_CAR", "GONDOLA", "FUNICULAR", "TRANSIT"}
-    if mode in transit_modes:
+    if mode in TRANSIT_MODES:
         route = leg.get("route", {}) or {}
         trip = leg.get("trip", {}) or {}
 
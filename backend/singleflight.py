@@ -0,0 +1,61 @@
+# backend/singleflight.py
+"""
+短時間 TTL 付きの single-flight キャッシュ
+
+同じキーに対する同時呼び出しを1回の上流呼び出しにまとめ、
+取得した結果を ttl 秒だけ再利用する。
+GTFS-RT は 15 秒程度でしか更新されないため、複数クライアントの
+ほぼ同時のポーリングを1回の ODPT API 呼び出しで処理できる。
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """キー単位で in-flight の取得処理を共有し、結果を TTL 付きで保持する"""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        # key -> (取得時刻 [monotonic], 値)
+        self._cache: Dict[Hashable, Tuple[float, Any]] = {}
+        # key -> 実行中の取得タスク
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        key の値を返す。TTL 内のキャッシュがあればそれを、
+        取得中のタスクがあればその完了を待って結果を返す。
+
+        Args:
+            key: キャッシュキー
+            factory: 値を取得するコルーチンを返す関数
+
+        Returns:
+            factory() の結果（例外は呼び出し元全員に伝播し、キャッシュされない）
+        """
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, factory))
+            self._inflight[key] = task
+
+        # 1つの呼び出し元がキャンセルされても共有タスクは継続させる
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await factory()
+            self._cache[key] = (time.monotonic(), value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def clear(self) -> None:
+        """キャッシュを破棄する（実行中のタスクはそのまま）"""
+        self._cache.clear()
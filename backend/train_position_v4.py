@@ -9,6 +9,8 @@ from __future__ import annotations
 import logging
 import math
 import time
+from array import array
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
 from typing import Dict, List, Optional, TYPE_CHECKING
 from station_ranks import get_station_dwell_time
@@ -59,7 +61,7 @@ def calculate_physics_progress(elapsed_time: float, total_duration: float) -> fl
 # Data Models
 # ============================================================================
 
-@dataclass
+@dataclass(slots=True)
 class SegmentProgress:
     """列車の現在位置・進捗情報"""
     trip_id: str
@@ -339,6 +341,7 @@ def compute_all_progress(
     schedules: Dict[str, TrainSchedule],
     now_ts: Optional[int] = None,
     data_cache: "DataCache" | None = None,
+    drop_invalid: bool = False,
 ) -> List[SegmentProgress]:
     """
     複数列車の現在位置・進捗をまとめて計算する。
@@ -346,6 +349,8 @@ def compute_all_progress(
     Args:
         schedules: {trip_id: TrainSchedule} の辞書（MS1の出力）
         now_ts: 現在時刻（unix seconds）。None なら time.time() を使用。
+        drop_invalid: True なら status="invalid" の結果を返さない
+            （表示にしか使わない呼び出し側で invalid を読み飛ばすループを省く）
     
     Returns:
         SegmentProgress のリスト
@@ -359,9 +364,13 @@ def compute_all_progress(
     for trip_id, schedule in schedules.items():
         try:
             progress = compute_progress_for_train(schedule, now_ts, data_cache)
+            if drop_invalid and progress.status == "invalid":
+                continue
             results.append(progress)
         except Exception as e:
             logger.error(f"Failed to compute progress for {trip_id}: {e}")
+            if drop_invalid:
+                continue
             # エラーでも結果を返す
             results.append(SegmentProgress(
                 trip_id=trip_id,
@@ -429,51 +438,119 @@ def get_merged_coords(cache, line_id) -> List[tuple[float, float]]:
     if line_id in _SHAPE_CACHE:
         return _SHAPE_CACHE[line_id]
     
-    merged: List[List[float]] = []
-    # coordinates.json content is in cache.coordinates["railways"]
-    railways = cache.coordinates.get("railways", [])
-    for r in railways:
-        if r.get("id") == line_id:
-            previous_end = None
-            for sl in r.get("sublines", []):
-                coords = sl.get("coords") or []
-                if not coords:
-                    continue
-
-                # Match /api/shapes merge order to keep sublines continuous.
-                if previous_end is not None:
-                    first = coords[0]
-                    last = coords[-1]
-                    dist_to_first = (first[0] - previous_end[0]) ** 2 + (first[1] - previous_end[1]) ** 2
-                    dist_to_last = (last[0] - previous_end[0]) ** 2 + (last[1] - previous_end[1]) ** 2
-                    if dist_to_last < dist_to_first:
-                        coords = list(reversed(coords))
-
-                merged.extend(coords)
-                previous_end = coords[-1]
-            break
-            
-    # Convert to list of tuples (lon, lat)
-    merged_tuples = [(c[0], c[1]) for c in merged]
-    
-    if merged_tuples:
-        _SHAPE_CACHE[line_id] = merged_tuples
+    # (lon, lat) タプルへ直接変換しながら連結する（中間リストを作らない）
+    merged: List[tuple[float, float]] = []
+    entry = cache.coord_entries_by_id.get(line_id)
+    if entry:
+        prev_x = prev_y = None
+        for sl in entry.get("sublines", []):
+            coords = sl.get("coords") or []
+            if not coords:
+                continue
+
+            # Match /api/shapes merge order to keep sublines continuous.
+            if prev_x is not None:
+                # 二乗ユークリッド距離（ローカル変数で計算し添字アクセスを減らす）
+                first = coords[0]
+                last = coords[-1]
+                dx = first[0] - prev_x
+                dy = first[1] - prev_y
+                dist_to_first = dx * dx + dy * dy
+                dx = last[0] - prev_x
+                dy = last[1] - prev_y
+                dist_to_last = dx * dx + dy * dy
+                if dist_to_last < dist_to_first:
+                    coords = coords[::-1]
+
+            merged.extend([(c[0], c[1]) for c in coords])
+            prev_x, prev_y = merged[-1]
+    
+    if merged:
+        _SHAPE_CACHE[line_id] = merged
         
-    return merged_tuples
+    return merged
+
+@dataclass
+class TrackPolyline:
+    """
+    マージ済み線路形状の列指向（SoA）表現。
+
+    各点の経度・緯度を別々の array('d') に持ち、
+    始点からの累積距離 [m] を事前計算しておく。
+    """
+    lons: array
+    lats: array
+    cum_dists: array  # cum_dists[i] = 点0 から点i までの線路沿い距離
+
+    def __len__(self) -> int:
+        return len(self.lons)
+
+
+_POLYLINE_CACHE: Dict[str, TrackPolyline] = {}
+
+
+def get_track_polyline(cache, line_id) -> Optional[TrackPolyline]:
+    """get_merged_coords の結果を SoA + 累積距離に変換してキャッシュする"""
+    polyline = _POLYLINE_CACHE.get(line_id)
+    if polyline is not None:
+        return polyline
+
+    coords = get_merged_coords(cache, line_id)
+    if not coords:
+        return None
+
+    lons = array("d", [c[0] for c in coords])
+    lats = array("d", [c[1] for c in coords])
+    cum_dists = array("d", [0.0])
+    total = 0.0
+    for i in range(1, len(coords)):
+        total += get_distance_meters(lats[i - 1], lons[i - 1], lats[i], lons[i])
+        cum_dists.append(total)
+
+    polyline = TrackPolyline(lons=lons, lats=lats, cum_dists=cum_dists)
+    _POLYLINE_CACHE[line_id] = polyline
+    return polyline
+
+
+# (line_id, station_id) -> (最近傍の線路点インデックス, 距離 [m])
+_STATION_SNAP_CACHE: Dict[tuple[str, str], tuple[int, float]] = {}
+
+
+def snap_station_to_polyline(
+    polyline: TrackPolyline,
+    line_id: str,
+    station_id: str,
+    lon: float,
+    lat: float,
+) -> tuple[int, float]:
+    """
+    駅座標に最も近い線路点のインデックスと距離を返す。
+
+    線路形状も駅座標も起動後は変わらないため、結果は (line_id, station_id) で
+    キャッシュし、同じ駅を通る列車間で全探索を共有する。
+    """
+    key = (line_id, station_id)
+    snapped = _STATION_SNAP_CACHE.get(key)
+    if snapped is not None:
+        return snapped
+
+    best_idx = -1
+    best_d = float('inf')
+    # 単純全探索
+    for i, (p_lon, p_lat) in enumerate(zip(polyline.lons, polyline.lats)):
+        d = get_distance_meters(lat, lon, p_lat, p_lon)
+        if d < best_d:
+            best_d = d
+            best_idx = i
+
+    snapped = (best_idx, best_d)
+    _STATION_SNAP_CACHE[key] = snapped
+    return snapped
+
 
 def _get_station_coord_v4(station_id, cache) -> Optional[tuple[float, float]]:
-    # Step 2: Unified accessor (DB-backed)
-    # cache.get_station_coord returns (lon, lat)
-    if hasattr(cache, "get_station_coord"):
-        c = cache.get_station_coord(station_id)
-        if c:
-             return (c[0], c[1])
-
-    # Fallback to direct access if method missing
-    coord = cache.station_positions.get(station_id)
-    if coord:
-        return (coord[0], coord[1])
-    return None
+    # Step 2: DB 由来の station_positions を直接引く（(lon, lat) のタプルをそのまま返す）
+    return cache.station_positions.get(station_id)
 
 def calculate_bearing(lat1, lon1, lat2, lon2):
     """
@@ -548,9 +625,9 @@ def calculate_coordinates(
             return None
 
         try:
-            # 線路点群の取得
-            coords = get_merged_coords(cache, line_id)
-            if not coords:
+            # 線路点群の取得（SoA + 累積距離）
+            polyline = get_track_polyline(cache, line_id)
+            if not polyline:
                 return linear_fallback()
 
             # 前駅・次駅の座標
@@ -563,22 +640,9 @@ def calculate_coordinates(
             e_lon, e_lat = e_coord
 
             # 最近傍探索 (距離ガード: 500m)
-            idx_prev = -1
-            min_d_prev = float('inf')
-            idx_next = -1
-            min_d_next = float('inf')
-
-            # 単純全探索
-            for i, (lon, lat) in enumerate(coords):
-                d_prev = get_distance_meters(s_lat, s_lon, lat, lon)
-                if d_prev < min_d_prev:
-                    min_d_prev = d_prev
-                    idx_prev = i
-                
-                d_next = get_distance_meters(e_lat, e_lon, lat, lon)
-                if d_next < min_d_next:
-                    min_d_next = d_next
-                    idx_next = i
+            # 駅ごとのスナップ結果はキャッシュされるため、全探索は駅ごとに初回のみ
+            idx_prev, min_d_prev = snap_station_to_polyline(polyline, line_id, prev_station_id, s_lon, s_lat)
+            idx_next, min_d_next = snap_station_to_polyline(polyline, line_id, next_station_id, e_lon, e_lat)
 
             if min_d_prev > 500 or min_d_next > 500:
                 # 駅が線路から遠すぎる
@@ -588,55 +652,44 @@ def calculate_coordinates(
             if idx_prev == idx_next:
                 return linear_fallback()
 
-            # パス切り出し
-            if idx_prev < idx_next:
-                path = coords[idx_prev : idx_next + 1]
-            else:
-                path = coords[idx_next : idx_prev + 1][::-1]
-
-            # パス長計算 & 位置特定
-            total_dist = 0.0
-            dists = [0.0]
-            for i in range(len(path) - 1):
-                p1 = path[i]
-                p2 = path[i+1]
-                d = get_distance_meters(p1[1], p1[0], p2[1], p2[0])
-                total_dist += d
-                dists.append(total_dist)
-            
+            # パス長は累積距離の差で求める（点列の切り出し・再計算は不要）
+            cum = polyline.cum_dists
+            total_dist = abs(cum[idx_next] - cum[idx_prev])
             if total_dist <= 0:
                 return linear_fallback()
 
-            target_dist = total_dist * progress
+            traveled = total_dist * progress
 
-            # target_dist に対応する区間を探す
-            found_idx = 0
-            for i in range(len(dists) - 1):
-                if dists[i] <= target_dist <= dists[i+1]:
-                    found_idx = i
-                    break
-            
-            # 区間内補間
-            # d_start = dists[found_idx] # unused
-            d_end = dists[found_idx+1]
-            seg_len = d_end - dists[found_idx]
-            
-            # p_start, p_end for bearing calculation
-            p_start = path[found_idx] # (lon, lat)
-            p_end = path[found_idx+1] # (lon, lat)
-            
+            # target に対応する区間 [j, j+1] を二分探索で探す
+            if idx_prev < idx_next:
+                target = cum[idx_prev] + traveled
+                j = bisect_right(cum, target, idx_prev, idx_next) - 1
+                j = min(max(j, idx_prev), idx_next - 1)
+                i_start, i_end = j, j + 1
+            else:
+                # 逆方向: 点 j+1 → 点 j へ進む
+                target = cum[idx_prev] - traveled
+                j = bisect_left(cum, target, idx_next, idx_prev) - 1
+                j = min(max(j, idx_next), idx_prev - 1)
+                i_start, i_end = j + 1, j
+
+            lons = polyline.lons
+            lats = polyline.lats
+            start_lon, start_lat = lons[i_start], lats[i_start]
+            end_lon, end_lat = lons[i_end], lats[i_end]
+
+            # 方位角の計算
+            bearing = calculate_bearing(start_lat, start_lon, end_lat, end_lon)
+
+            seg_len = abs(cum[i_end] - cum[i_start])
             if seg_len <= 0:
                 # 区間長0なら始点座標
-                bearing = calculate_bearing(p_start[1], p_start[0], p_end[1], p_end[0]) if len(path) > 1 else 0
-                return (p_start[1], p_start[0], bearing)
+                return (start_lat, start_lon, bearing)
 
-            ratio = (target_dist - dists[found_idx]) / seg_len
-            
-            res_lon = p_start[0] + (p_end[0] - p_start[0]) * ratio
-            res_lat = p_start[1] + (p_end[1] - p_start[1]) * ratio
+            ratio = abs(target - cum[i_start]) / seg_len
             
-            # 方位角の計算
-            bearing = calculate_bearing(p_start[1], p_start[0], p_end[1], p_end[0])
+            res_lon = start_lon + (end_lon - start_lon) * ratio
+            res_lat = start_lat + (end_lat - start_lat) * ratio
             
             return (res_lat, res_lon, bearing)
 
@@ -649,9 +702,7 @@ def calculate_coordinates(
         # 最初に prev_station_id、なければ next_station_id を使用
         station_id = progress_data.prev_station_id or progress_data.next_station_id
         if station_id:
-            coord = _get_station_coord_v4(station_id, cache)
-            if coord:
-                lon, lat = coord
-                return (lat, lon)
+            # 起動時に構築済みの (lat, lon) タプルをそのまま返す
+            return cache.station_latlon.get(station_id)
 
     return None